@@ -0,0 +1,971 @@
+# -*- coding: utf-8 -*-
+'''
+#
+# PROJECT: GPTPLUS
+# Benchmarks of the gptplus hot paths, run against local fake servers (no real API key is used)
+#
+# USAGE :
+# python benchmark_gptplus.py streaming --chats 10
+# python benchmark_gptplus.py images --requests 20 --distinct 5
+# python benchmark_gptplus.py history --users 10000
+# python benchmark_gptplus.py http --requests 200
+# python benchmark_gptplus.py intents
+# python benchmark_gptplus.py weather
+# python benchmark_gptplus.py telegram
+# python benchmark_gptplus.py logging
+# python benchmark_gptplus.py webhook --updates recorded_updates.jsonl
+# python benchmark_gptplus.py e2e --users 20 --messages 5 --openai-latency 0.3 --error-rate 0.02
+# python benchmark_gptplus.py e2e --metrics (time spent in each stage of the pipeline)
+# python benchmark_gptplus.py metrics
+# python benchmark_gptplus.py shards --workers 1,2,4 (add --restart for a rolling restart in the middle)
+# python benchmark_gptplus.py shards-e2e --workers 2 --chats 20 --messages 3 (real worker processes against the fake servers)
+# python benchmark_gptplus.py fakes (prints the [ENDPOINTS] section to run the bot itself against the fake servers)
+#
+'''
+import argparse
+import asyncio
+import collections
+import datetime
+import hashlib
+import json
+import math
+import os
+import random
+import re
+import resource
+import sys
+import tempfile
+import time
+import tracemalloc
+import types
+import aiohttp
+from aiohttp import web
+from aiogram import Bot, Dispatcher
+from aiogram.types import Update
+import httpx
+import openai
+import gptplus
+
+# fake OpenAI server that streams a chat completion as server-sent events and generates fake images
+async def start_fake_openai_server(chunks=20, chunk_delay=0.05, image_delay=1.0):
+    async def chat_completions(request):
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await response.prepare(request)
+        for i in range(chunks):
+            await asyncio.sleep(chunk_delay)
+            data = {"id": "chatcmpl-bench", "object": "chat.completion.chunk", "model": "gpt-4",
+                    "choices": [{"index": 0, "delta": {"content": f"Word{i} "}, "finish_reason": None}]}
+            await response.write(f"data: {json.dumps(data)}\n\n".encode())
+        await response.write(b"data: [DONE]\n\n")
+        await response.write_eof()
+        return response
+
+    async def images_generations(request):
+        payload = await request.json()
+        await asyncio.sleep(image_delay)
+        return web.json_response({"created": int(time.time()), "data": [{"url": f"https://images.example/{abs(hash(payload['prompt']))}.png"}]})
+
+    app = web.Application()
+    app.router.add_post("/v1/chat/completions", chat_completions)
+    app.router.add_post("/v1/images/generations", images_generations)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]  # type: ignore
+    return runner, f"http://127.0.0.1:{port}/v1"
+
+# fake data API answering every request with a small JSON document
+async def start_fake_data_server(delay=0.0):
+    async def handler(request):
+        await asyncio.sleep(delay)
+        return web.json_response({"ok": True, "path": request.path})
+
+    app = web.Application()
+    app.router.add_get("/{tail:.*}", handler)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]  # type: ignore
+    return runner, f"http://127.0.0.1:{port}"
+
+# fake aiogram bot that only counts the calls made to the Telegram API
+class FakeBot:
+    def __init__(self):
+        self.calls = 0
+        self.messages = 0
+
+    async def send_message(self, chat_id, text, **kwargs):
+        self.calls += 1
+        self.messages += 1
+        return types.SimpleNamespace(message_id=self.messages)
+
+    async def edit_message_text(self, text, chat_id=None, message_id=None, **kwargs):
+        self.calls += 1
+
+async def benchmark_streaming(chats, chunks, chunk_delay):
+    runner, api_base = await start_fake_openai_server(chunks, chunk_delay)
+    gptplus.is_authorized_chat = lambda chat_id: True
+    openai.api_base = api_base
+    openai.api_key = "bench"
+    session = gptplus.create_openai_session()
+    bot = FakeBot()
+    try:
+        start = time.perf_counter()
+        await gptplus.get_gpt4_response("Tell me a joke", [], bot, 1)
+        single = time.perf_counter() - start
+
+        start = time.perf_counter()
+        await asyncio.gather(*[gptplus.get_gpt4_response("Tell me a joke", [], bot, chat_id) for chat_id in range(chats)])
+        concurrent = time.perf_counter() - start
+    finally:
+        await session.close()
+        await runner.cleanup()
+
+    print(f"one chat: {single:.2f}s")
+    print(f"{chats} concurrent chats: {concurrent:.2f}s (one after another would take ~{single * chats:.2f}s)")
+    print(f"throughput: {chats * chunks / concurrent:.0f} chunks/s, speedup x{single * chats / concurrent:.1f}")
+
+async def benchmark_images(requests, distinct, image_delay):
+    runner, api_base = await start_fake_openai_server(image_delay=image_delay)
+    openai.api_base = api_base
+    openai.api_key = "bench"
+    session = gptplus.create_openai_session()
+    pool = gptplus.image_pool
+    pool.start()
+    try:
+        prompts = [f"a cat number {i % distinct}" for i in range(requests)]
+        start = time.perf_counter()
+        urls = await asyncio.gather(*[pool.submit(prompt) for prompt in prompts])
+        elapsed = time.perf_counter() - start
+    finally:
+        await pool.stop()
+        await session.close()
+        await runner.cleanup()
+
+    stats = pool.stats()
+    print(f"{requests} image requests ({distinct} distinct prompts) with {pool.workers} workers: {elapsed:.2f}s")
+    print(f"generated: {stats['jobs']}, merged: {stats['merged']}, failed: {urls.count(None)}, average latency: {stats['average_latency']:.2f}s")
+
+async def benchmark_history(users, turns):
+    conversation = [{"role": "user", "content": "What is the weather in Geneva?"}, {"role": "gpt4", "content": "It is sunny in Geneva today. " * 5}] * 3
+    with tempfile.TemporaryDirectory() as directory:
+        json_file = os.path.join(directory, "conversation_history.json")
+        with open(json_file, "w", encoding="utf-8") as f:
+            json.dump({str(user_id): conversation for user_id in range(users)}, f, ensure_ascii=False, indent=4)
+
+        start = time.perf_counter()
+        backend = gptplus.SQLiteHistoryBackend(os.path.join(directory, "conversation_history.sqlite3"))
+        gptplus.migrate_json_history(backend, json_file)
+        print(f"migration of {users} users: {time.perf_counter() - start:.2f}s")
+        os.replace(json_file + ".migrated", json_file)
+
+        stores = [
+            ("json file rewritten per message", gptplus.ConversationHistoryStore(gptplus.JSONHistoryBackend(json_file), cache_size=0), max(turns // 20, 1), False),
+            ("sqlite, one write per message", gptplus.ConversationHistoryStore(backend, cache_size=0), turns, False),
+            ("sqlite, LRU and write-behind", gptplus.ConversationHistoryStore(backend, cache_size=1000, flush_interval=0.5), turns, True),
+        ]
+        for name, store, count, background in stores:
+            if background:
+                store.start()
+            start = time.perf_counter()
+            for turn in range(count):
+                # hot users come back often, as in a real chat
+                user_id = random.randrange(users) if turn % 4 == 0 else random.randrange(100)
+                user_messages = store.load(user_id)
+                user_messages.append({"role": "user", "content": f"message {turn}"})
+                store.save(user_id, user_messages[-6:])
+                await asyncio.sleep(0)
+            elapsed = time.perf_counter() - start
+            if background:
+                await store.close()
+            print(f"{name}: {elapsed / count * 1000:.3f} ms per message ({count} messages, {users} users)")
+
+async def benchmark_http(requests):
+    runner, base_url = await start_fake_data_server()
+    try:
+        start = time.perf_counter()
+        for i in range(requests):
+            async with httpx.AsyncClient() as client:
+                await client.get(f"{base_url}/v1/tickers/{i}")
+        per_call = time.perf_counter() - start
+
+        gptplus.http_client = gptplus.create_http_client()
+        start = time.perf_counter()
+        for i in range(requests):
+            await gptplus.http_get(f"{base_url}/v1/tickers/{i}")
+        shared = time.perf_counter() - start
+        await gptplus.http_client.aclose()
+    finally:
+        await runner.cleanup()
+
+    print(f"new client per request: {per_call / requests * 1000:.2f} ms per request")
+    print(f"shared pooled client: {shared / requests * 1000:.2f} ms per request")
+    for host, latency in gptplus.host_latencies.items():
+        print(f"{host}: {latency.summary()}")
+
+async def benchmark_telegram(characters, chunk_delay):
+    words = [f"{'lorem' if i % 2 else 'ipsum'}{'.' if i % 12 == 11 else ''} " for i in range(characters // 6)]
+    answer = "".join(words)
+    # previous versions sent one message per sentence
+    legacy_calls = len([sentence for sentence in re.split(r'(?<!\d)\.(?=\s|$)', answer) if sentence])
+
+    bot = FakeBot()
+    renderer = gptplus.TelegramStreamRenderer(bot, 1)
+    start = time.perf_counter()
+    for word in words:
+        await renderer.feed(word)
+        await asyncio.sleep(chunk_delay)
+    await renderer.finish()
+    elapsed = time.perf_counter() - start
+
+    print(f"answer of {len(answer)} characters streamed in {elapsed:.1f}s")
+    print(f"one message per sentence: {legacy_calls} API calls")
+    print(f"edited in place: {bot.calls} API calls in {bot.messages} messages")
+
+def benchmark_logging(messages, calls_per_message):
+    weather_prompt = f"Voici les données météo : {fake_weather_payload()}"
+    with tempfile.TemporaryDirectory() as directory:
+        # previous versions opened, wrote and closed the log file for each call, with the whole prompt
+        legacy_file = os.path.join(directory, "legacy-log.txt")
+        start = time.perf_counter()
+        for _ in range(messages):
+            for call in range(calls_per_message):
+                with open(legacy_file, "a", encoding='utf-8') as log_file:
+                    log_file.write(f"{datetime.datetime.now()} - {weather_prompt if call == 0 else 'Successful retrieval of weather data'}\n")
+        legacy = time.perf_counter() - start
+
+        writer = gptplus.log_writer
+        gptplus.log_writer = gptplus.LogWriter(os.path.join(directory, "log.txt"), gptplus.LOG_MAX_BYTES, 0, 1)
+        start = time.perf_counter()
+        for _ in range(messages):
+            for call in range(calls_per_message):
+                if call == 0:
+                    gptplus.log_message("Context sent to the model", external_data=weather_prompt)
+                else:
+                    gptplus.log_message("Successful retrieval of weather data")
+        buffered = time.perf_counter() - start
+        gptplus.log_writer.close()
+        gptplus.log_writer = writer
+
+    print(f"file opened per call: {legacy / messages * 1000:.3f} ms of blocking per message ({calls_per_message} log calls)")
+    print(f"queue and background thread: {buffered / messages * 1000:.3f} ms of blocking per message ({calls_per_message} log calls)")
+
+# Telegram update of a text message, as posted to the webhook
+def fake_update(update_id, chat_id, text):
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id, "date": int(time.time()), "text": text,
+            "chat": {"id": chat_id, "type": "private", "first_name": "Bench"},
+            "from": {"id": chat_id, "is_bot": False, "first_name": "Bench"},
+        },
+    }
+
+async def benchmark_webhook(updates_file, url, secret_token, count, chats, concurrency, handler_delay):
+    if updates_file:
+        with open(updates_file, "r", encoding="utf-8") as f:
+            updates = [json.loads(line) for line in f if line.strip()]
+    else:
+        updates = [fake_update(i, i % chats, f"message {i}") for i in range(count)]
+
+    server = None
+    if not url:
+        # in-process webhook server with a handler that only waits, to measure the ingestion itself
+        bot = Bot(token="123456:AAbenchmarkbenchmarkbenchmarkbenchmar")
+        dp = Dispatcher(bot)
+
+        async def handler(message):
+            await asyncio.sleep(handler_delay)
+
+        dp.register_message_handler(handler, content_types=['text'])
+        server = gptplus.WebhookServer(dp, gptplus.WEBHOOK_QUEUE_SIZE, gptplus.WEBHOOK_WORKERS, gptplus.WEBHOOK_DRAIN_TIMEOUT, gptplus.WEBHOOK_SECRET_TOKEN)
+        secret_token = gptplus.WEBHOOK_SECRET_TOKEN
+        await server.start("127.0.0.1", 0)
+        port = server.runner.addresses[0][1]  # type: ignore
+        url = f"http://127.0.0.1:{port}{gptplus.WEBHOOK_PATH}"
+
+    latencies = []
+    refused = 0
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def post(session, update):
+        nonlocal refused
+        async with semaphore:
+            while True:
+                start = time.perf_counter()
+                async with session.post(url, json=update, headers={"X-Telegram-Bot-Api-Secret-Token": secret_token}) as response:
+                    latencies.append(time.perf_counter() - start)
+                    if response.status != 503:
+                        return
+                # like Telegram, an update refused because of the backpressure is sent again later
+                refused += 1
+                await asyncio.sleep(0.05)
+
+    start = time.perf_counter()
+    async with aiohttp.ClientSession() as session:
+        await asyncio.gather(*[post(session, update) for update in updates])
+    posted = time.perf_counter() - start
+    if server is not None:
+        await server.stop()
+    elapsed = time.perf_counter() - start
+
+    latencies.sort()
+    print(f"{len(updates)} updates posted in {posted:.2f}s: {len(updates) / posted:.0f} updates/s, request p99 {latencies[int(len(latencies) * 0.99) - 1] * 1000:.1f} ms, {refused} refused by backpressure")
+    if server is not None:
+        stats = server.stats()
+        print(f"all processed in {elapsed:.2f}s: {len(updates) / elapsed:.0f} updates/s, handler p50 {stats['p50_latency'] * 1000:.1f} ms, p99 {stats['p99_latency'] * 1000:.1f} ms (queue {gptplus.WEBHOOK_QUEUE_SIZE}, {gptplus.WEBHOOK_WORKERS} workers)")
+
+# Open-Meteo forecast of 3 days with the same variables as the bot asks for
+def fake_weather_payload(days=3):
+    start = datetime.datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
+    hours = [start + datetime.timedelta(hours=hour) for hour in range(24 * days)]
+    dates = [start + datetime.timedelta(days=day) for day in range(days)]
+    return {
+        "latitude": 46.2, "longitude": 6.14, "generationtime_ms": 0.5, "utc_offset_seconds": 7200, "timezone": "Europe/Zurich", "timezone_abbreviation": "CEST", "elevation": 375.0,
+        "current_weather": {"temperature": 14.2, "windspeed": 9.4, "winddirection": 220, "weathercode": 3, "is_day": 1, "time": f"{datetime.datetime.now():%Y-%m-%dT%H}:00"},
+        "hourly_units": {"time": "iso8601", "temperature_2m": "°C", "relativehumidity_2m": "%", "precipitation": "mm", "surface_pressure": "hPa", "cloudcover": "%", "windspeed_10m": "km/h"},
+        "hourly": {
+            "time": [f"{hour:%Y-%m-%dT%H:%M}" for hour in hours],
+            "temperature_2m": [round(10 + 6 * math.sin(i / 24 * 2 * math.pi), 1) for i in range(len(hours))],
+            "relativehumidity_2m": [60 + (i * 7) % 35 for i in range(len(hours))],
+            "precipitation": [round(0.4 * (i % 11 == 0 or i % 11 == 1), 1) for i in range(len(hours))],
+            "surface_pressure": [round(965 + (i % 5) * 0.7, 1) for i in range(len(hours))],
+            "cloudcover": [(i * 13) % 100 for i in range(len(hours))],
+            "windspeed_10m": [round(5 + (i * 3) % 17 * 0.9, 1) for i in range(len(hours))],
+        },
+        "daily_units": {"time": "iso8601", "sunrise": "iso8601", "sunset": "iso8601", "uv_index_max": ""},
+        "daily": {
+            "time": [f"{date:%Y-%m-%d}" for date in dates],
+            "sunrise": [f"{date:%Y-%m-%d}T07:41" for date in dates],
+            "sunset": [f"{date:%Y-%m-%d}T18:37" for date in dates],
+            "uv_index_max": [3.1, 2.4, 4.0][:days],
+        },
+    }
+
+def benchmark_weather(repeat):
+    weather_data = fake_weather_payload()
+    before = gptplus.count_tokens(f"{weather_data}")
+    print(f"full forecast in the prompt: {before} tokens")
+    for prompt in ["Quelle est la météo à Genève ?", "Will there be rain in Geneva?", "Wind in Geneva tomorrow?"]:
+        start = time.perf_counter()
+        for _ in range(repeat):
+            summary = gptplus.summarize_weather(weather_data, prompt)
+        elapsed = time.perf_counter() - start
+        print(f"'{prompt}': {gptplus.count_tokens(summary)} tokens (x{before / gptplus.count_tokens(summary):.0f} less), built in {elapsed / repeat * 1e6:.0f} µs")
+
+# prompts labeled with the lookups they really need, as (kind, key)
+INTENT_CORPUS = [
+    ("Quel est le prix du bitcoin ?", {("crypto", "btc-bitcoin")}),
+    ("bitcoin et ethereum aujourd'hui", {("crypto", "btc-bitcoin"), ("crypto", "eth-ethereum")}),
+    ("How much is monero worth?", {("crypto", "xmr-monero")}),
+    ("Quelles sont les actualités en France ?", {("news", "france")}),
+    ("Donne moi les infos suisse", {("news", "suisse")}),
+    ("What are the news in the world?", {("news", "monde")}),
+    ("Swiss headlines please", {("news", "suisse")}),
+    ("Quelle est l'actualité ?", {("news", "monde")}),
+    ("Quelle est la météo à Genève ?", {("weather", "genève")}),
+    ("Prévision pour Lausanne demain", {("weather", "lausanne")}),
+    ("What's the weather in Paris?", {("weather", "paris")}),
+    ("Will there be rain in London tomorrow?", {("weather", "london")}),
+    ("Forecast for Berlin", {("weather", "berlin")}),
+    ("bitcoin price and weather in Zurich", {("crypto", "btc-bitcoin"), ("weather", "zurich")}),
+    ("What is the weather for the weekend?", set()),
+    ("Temperature for tomorrow", set()),
+    ("Wind at night in Geneva", {("weather", "geneva")}),
+    ("La météo pour demain à Lyon", {("weather", "lyon")}),
+    ("What's the weather like? I live in a small flat", set()),
+    ("Tell me a joke about a new car", set()),
+    ("I knew you would say that", set()),
+    ("Write a poem about renewable energy", set()),
+    ("What is the usage of this function?", set()),
+    ("Explain the Sunday effect in finance", set()),
+    ("Un événement important a eu lieu", set()),
+    ("Je n'ai pas le temps de lire tout ça", set()),
+    ("Sunscreen advice for kids", set()),
+    ("Explain how a neural network learns", set()),
+    ("Écris une invention farfelue", set()),
+    ("The rainbow in my garden is beautiful", set()),
+    ("Translate 'newspaper' in French", set()),
+    ("Can you summarize this article for me?", set()),
+    ("Qui a inventé le téléphone ?", set()),
+    ("Informatique : comment fonctionne un compilateur ?", set()),
+    ("Explain the Windows registry", set()),
+]
+
+# detection of the previous versions, kept as a reference
+def legacy_plan_external_lookups(prompt):
+    lookups = set()
+    for crypto in [{"name": "bitcoin", "id": "btc-bitcoin"}, {"name": "ethereum", "id": "eth-ethereum"}, {"name": "avax", "id": "avax-avalanche"}, {"name": "monero", "id": "xmr-monero"}]:
+        if crypto["name"] in prompt.lower():
+            lookups.add(("crypto", crypto["id"]))
+    if "actualités" in prompt.lower() or "l'actualité" in prompt.lower() or "nouvelles" in prompt.lower() or "infos" in prompt.lower() or "informations" in prompt.lower():
+        category = "monde" if "monde" in prompt.lower() else "france" if "france" in prompt.lower() or "française" in prompt.lower() else "suisse" if "suisse" in prompt.lower() else "usa" if "usa" in prompt.lower() else "monde"
+        lookups.add(("news", category))
+    if "news" in prompt.lower() or "new" in prompt.lower() or "headlines" in prompt.lower():
+        category = "monde" if "world" in prompt.lower() else "france" if "france" in prompt.lower() or "french" in prompt.lower() else "suisse" if "switzerland" in prompt.lower() or "swiss" in prompt.lower() else "usa" if "usa" in prompt.lower() else "monde"
+        lookups.add(("news", category))
+    keywords = ["temps", "météo", "température", "soleil", "uv", "vent", "pluie", "humidité", "prévision"]
+    if any(keyword in prompt.lower() for keyword in keywords):
+        city_match = re.search(r"\b(?:météo|temps|température|prévision|soleil|uv|vent|pluie|humidité)\s+(?:à|pour|a)?\s+(\w+)", prompt.lower())
+        if city_match:
+            lookups.add(("weather", city_match.group(1)))
+    keywords = ["weather","temperature","forecast","sun","uv","wind","rain","humidity"]
+    if any(keyword in prompt.lower() for keyword in keywords):
+        city_match = re.search(r"\b(?:weather|temperature|forecast|sun|uv|wind|rain|humidity)\s+(?:à|pour|in|of)?\s+(\w+)", prompt.lower())
+        if city_match:
+            lookups.add(("weather", city_match.group(1)))
+    return lookups
+
+def benchmark_intents(repeat):
+    detectors = [
+        ("substring scans (previous versions)", legacy_plan_external_lookups),
+        ("compiled single pass", lambda prompt: {lookup[:2] for lookup in gptplus.plan_external_lookups(prompt)}),
+    ]
+    for name, detect in detectors:
+        start = time.perf_counter()
+        for _ in range(repeat):
+            for prompt, _ in INTENT_CORPUS:
+                detect(prompt)
+        elapsed = time.perf_counter() - start
+
+        false_positives = missed = 0
+        for prompt, expected in INTENT_CORPUS:
+            detected = detect(prompt)
+            false_positives += len(detected - expected)
+            missed += len(expected - detected)
+        print(f"{name}: {elapsed / (repeat * len(INTENT_CORPUS)) * 1e6:.1f} µs per prompt, {false_positives} useless fetches, {missed} missed fetches on {len(INTENT_CORPUS)} prompts")
+
+# local stand-in of an upstream API, with a latency, an error rate and a count of the calls of each route
+class FakeUpstream:
+    def __init__(self, name, latency=0.0, error_rate=0.0, error_status=500, error_body=None):
+        self.name = name
+        self.latency = latency
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.error_body = error_body or {"error": "fake upstream error"}
+        self.app = web.Application()
+        self.calls = collections.Counter()
+        self.errors = 0
+        self.runner = None
+        self.url = None
+
+    # name is the counter of the route, the "method" of the path is used when it is empty
+    def route(self, method, path, handler, name=None):
+        async def wrapper(request):
+            self.calls[name or request.match_info["method"]] += 1
+            if self.latency:
+                await asyncio.sleep(self.latency * random.uniform(0.5, 1.5))
+            if random.random() < self.error_rate:
+                self.errors += 1
+                return web.json_response(self.error_body, status=self.error_status)
+            return await handler(request)
+        self.app.router.add_route(method, path, wrapper)
+
+    async def start(self, port=0):
+        self.runner = web.AppRunner(self.app)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, "127.0.0.1", port)
+        await site.start()
+        self.url = f"http://127.0.0.1:{site._server.sockets[0].getsockname()[1]}"  # type: ignore
+
+    async def stop(self):
+        await self.runner.cleanup()
+
+def create_fake_openai(latency, error_rate, answer_tokens, tokens_per_second, image_delay):
+    upstream = FakeUpstream("openai", latency, error_rate, error_body={"error": {"message": "The server had an error while processing your request.", "type": "server_error"}})
+
+    async def chat_completions(request):
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await response.prepare(request)
+        for i in range(answer_tokens):
+            await asyncio.sleep(1 / tokens_per_second)
+            data = {"id": "chatcmpl-bench", "object": "chat.completion.chunk", "model": "gpt-4",
+                    "choices": [{"index": 0, "delta": {"content": ("lorem " if i % 2 else "ipsum ")}, "finish_reason": None}]}
+            await response.write(f"data: {json.dumps(data)}\n\n".encode())
+        await response.write(b"data: [DONE]\n\n")
+        await response.write_eof()
+        return response
+
+    async def images_generations(request):
+        payload = await request.json()
+        await asyncio.sleep(image_delay)
+        return web.json_response({"created": int(time.time()), "data": [{"url": f"https://images.example/{abs(hash(payload['prompt']))}.png"}]})
+
+    upstream.route("POST", "/v1/chat/completions", chat_completions, "chat/completions")
+    upstream.route("POST", "/v1/images/generations", images_generations, "images/generations")
+    return upstream
+
+# fake Bot API: the time of every message sent to a chat is kept to measure the time to the first message
+def create_fake_telegram(latency, error_rate):
+    upstream = FakeUpstream("telegram", latency, error_rate, error_status=429,
+                            error_body={"ok": False, "error_code": 429, "description": "Too Many Requests: retry after 1", "parameters": {"retry_after": 1}})
+    upstream.sent = collections.defaultdict(list)
+    message_ids = iter(range(1, 1 << 62))
+
+    async def bot_method(request):
+        data = await request.post()
+        chat_id = int(data.get("chat_id", 0))
+        if request.match_info["method"] in ("sendMessage", "sendPhoto"):
+            upstream.sent[chat_id].append(time.perf_counter())
+        message = {"message_id": next(message_ids), "date": int(time.time()), "chat": {"id": chat_id, "type": "private"}, "text": data.get("text", "")}
+        return web.json_response({"ok": True, "result": message})
+
+    upstream.route("POST", "/bot{token}/{method}", bot_method)
+    return upstream
+
+def create_fake_newsapi(latency, error_rate):
+    upstream = FakeUpstream("newsapi", latency, error_rate)
+
+    async def top_headlines(request):
+        country = request.query.get("country", request.query.get("language", "fr"))
+        articles = [{"title": f"Headline {i} of {country} - Bench News", "source": {"name": "Bench News"}, "description": "Lorem ipsum " * 20} for i in range(20)]
+        return web.json_response({"status": "ok", "totalResults": len(articles), "articles": articles})
+
+    upstream.route("GET", "/v2/top-headlines", top_headlines, "top-headlines")
+    return upstream
+
+# geocoding and forecast, the two Open-Meteo APIs are served by the same fake
+def create_fake_open_meteo(latency, error_rate):
+    upstream = FakeUpstream("open-meteo", latency, error_rate)
+
+    async def search(request):
+        name = request.query["name"]
+        seed = int(hashlib.md5(name.lower().encode()).hexdigest(), 16)
+        return web.json_response({"results": [{"name": name, "latitude": 40 + seed % 1000 / 100, "longitude": (seed >> 10) % 1000 / 100}]})
+
+    async def forecast(request):
+        return web.json_response(fake_weather_payload())
+
+    upstream.route("GET", "/v1/search", search, "search")
+    upstream.route("GET", "/v1/forecast", forecast, "forecast")
+    return upstream
+
+# like the real endpoint, the tickers of every listed coin (a few thousands) are returned, not only the followed ones
+def create_fake_coinpaprika(latency, error_rate, coins=3000):
+    upstream = FakeUpstream("coinpaprika", latency, error_rate)
+    ids = [coin["id"] for coin in gptplus.CRYPTO_REGISTRY] + [f"coin{i}-coin-{i}" for i in range(coins)]
+
+    async def tickers(request):
+        now = f"{datetime.datetime.utcnow():%Y-%m-%dT%H:%M:%SZ}"
+        return web.json_response([
+            {"id": coin_id, "name": coin_id.split("-", 1)[1].title(), "symbol": coin_id.split("-")[0].upper(), "rank": rank + 1,
+             "circulating_supply": 19000000, "total_supply": 21000000, "last_updated": now,
+             "quotes": {"USD": {"price": 30000 / (rank + 1), "volume_24h": 1e9 / (rank + 1), "market_cap": 5e11 / (rank + 1), "percent_change_1h": 0.1,
+                                "percent_change_24h": -1.2, "percent_change_7d": 3.4, "percent_change_30d": 5.6, "percent_change_1y": 78.9, "ath_price": 69000}}}
+            for rank, coin_id in enumerate(ids)
+        ])
+
+    upstream.route("GET", "/v1/tickers", tickers, "tickers")
+    return upstream
+
+async def start_fake_upstreams(args, ports=None):
+    upstreams = {
+        "openai": create_fake_openai(args.openai_latency, args.openai_error_rate, args.answer_tokens, args.tokens_per_second, args.image_delay),
+        "telegram": create_fake_telegram(args.telegram_latency, args.telegram_error_rate),
+        "newsapi": create_fake_newsapi(args.latency, args.error_rate),
+        "open-meteo": create_fake_open_meteo(args.latency, args.error_rate),
+        "coinpaprika": create_fake_coinpaprika(args.latency, args.error_rate),
+    }
+    for name, upstream in upstreams.items():
+        await upstream.start((ports or {}).get(name, 0))
+    return upstreams
+
+def endpoints_section(upstreams):
+    return "\n".join([
+        "[ENDPOINTS]",
+        f"OPENAI = {upstreams['openai'].url}/v1",
+        f"TELEGRAM = {upstreams['telegram'].url}",
+        f"NEWSAPI = {upstreams['newsapi'].url}",
+        f"GEOCODING = {upstreams['open-meteo'].url}",
+        f"WEATHER = {upstreams['open-meteo'].url}",
+        f"COINPAPRIKA = {upstreams['coinpaprika'].url}",
+    ])
+
+# same settings as the [ENDPOINTS] section, for the bot imported in this process
+def point_bot_at(upstreams):
+    openai.api_base = f"{upstreams['openai'].url}/v1"
+    openai.api_key = "bench"
+    gptplus.TELEGRAM_BASE_URL = upstreams["telegram"].url
+    gptplus.TELEGRAM_BOT_TOKEN = "123456:AAbenchmarkbenchmarkbenchmarkbenchmar"
+    gptplus.NEWSAPI_BASE_URL = upstreams["newsapi"].url
+    gptplus.GEOCODING_BASE_URL = upstreams["open-meteo"].url
+    gptplus.WEATHER_BASE_URL = upstreams["open-meteo"].url
+    gptplus.COINPAPRIKA_BASE_URL = upstreams["coinpaprika"].url
+
+E2E_PROMPTS = [
+    "Quelle est la météo à {city} demain ?",
+    "What is the weather in {city} this weekend?",
+    "Quelles sont les actualités en france ?",
+    "What are the news headlines in the world?",
+    "Quel est le prix du bitcoin ?",
+    "How much is ethereum worth this week?",
+    "Raconte-moi une blague sur les chats.",
+    "Explain the difference between a list and a tuple in Python.",
+]
+E2E_IMAGE_PROMPT = "génère un chat qui joue du piano"
+E2E_CITIES = ["Paris", "Genève", "Lausanne", "London", "Berlin", "Madrid", "Rome", "Lyon"]
+
+def percentiles(values):
+    values = sorted(values)
+    if not values:
+        return "n/a"
+    pick = lambda p: values[min(int(len(values) * p), len(values) - 1)] * 1000
+    return f"p50 {pick(0.5):.0f} ms, p90 {pick(0.9):.0f} ms, p99 {pick(0.99):.0f} ms, max {values[-1] * 1000:.0f} ms"
+
+# each user asks a question, waits for the whole answer, thinks and asks the next one
+async def run_e2e_user(chat_id, messages, think_time, image_rate, bot, telegram, results):
+    for i in range(messages):
+        text = E2E_IMAGE_PROMPT if random.random() < image_rate else random.choice(E2E_PROMPTS).format(city=random.choice(E2E_CITIES))
+        message = Update(**fake_update(chat_id * 10000 + i, chat_id, text)).message
+        sent_before = len(telegram.sent[chat_id])
+        start = time.perf_counter()
+        await gptplus.chat_scheduler.run(lambda: gptplus.handle_message(message, bot), f"message {i} of the chat {chat_id}")
+        results["latency"].append(time.perf_counter() - start)
+        sent = telegram.sent[chat_id][sent_before:]
+        if sent:
+            results["first_message"].append(sent[0] - start)
+        else:
+            results["unanswered"] += 1
+        if think_time:
+            await asyncio.sleep(random.expovariate(1 / think_time))
+
+async def benchmark_e2e(args):
+    gptplus.metrics.enabled = args.metrics
+    upstreams = await start_fake_upstreams(args)
+    point_bot_at(upstreams)
+    # the bot authorizes a single chat id, the simulated users each have their own chat
+    gptplus.is_authorized_chat = lambda chat_id: 1 <= chat_id <= args.users
+    # cold caches, the geocoding cache is loaded from its file at import
+    for cache in gptplus.caches + [gptplus.response_cache]:
+        cache.entries.clear()
+    if args.tracemalloc:
+        tracemalloc.start()
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    with tempfile.TemporaryDirectory() as directory:
+        gptplus.conversation_store = gptplus.ConversationHistoryStore(
+            gptplus.SQLiteHistoryBackend(os.path.join(directory, "conversation_history.sqlite3")), gptplus.HISTORY_CACHE_SIZE, gptplus.HISTORY_FLUSH_INTERVAL)
+        gptplus.conversation_store.start()
+        gptplus.http_client = gptplus.create_http_client()
+        session = gptplus.create_openai_session()
+        bot = gptplus.create_bot()
+        gptplus.image_pool.start()
+        results = {"latency": [], "first_message": [], "unanswered": 0}
+        try:
+            start = time.perf_counter()
+            await asyncio.gather(*[run_e2e_user(chat_id, args.messages, args.think_time, args.image_rate, bot, upstreams["telegram"], results)
+                                   for chat_id in range(1, args.users + 1)])
+            elapsed = time.perf_counter() - start
+        finally:
+            await gptplus.image_pool.stop()
+            await gptplus.conversation_store.close()
+            await session.close()
+            await gptplus.http_client.aclose()
+            await bot.close()
+            for upstream in upstreams.values():
+                await upstream.stop()
+
+    total = args.users * args.messages
+    print(f"{total} messages of {args.users} users in {elapsed:.2f}s: {total / elapsed:.1f} messages/s, {results['unanswered']} without any answer")
+    print(f"time to first message: {percentiles(results['first_message'])}")
+    print(f"end-to-end latency: {percentiles(results['latency'])}")
+    for name, upstream in upstreams.items():
+        calls = ", ".join(f"{route} {count}" for route, count in sorted(upstream.calls.items()))
+        print(f"{name}: {sum(upstream.calls.values())} calls ({calls or 'none'}), {upstream.errors} injected errors")
+    print(f"telegram calls per message: {sum(upstreams['telegram'].calls.values()) / total:.1f}, scheduler retries: {gptplus.chat_scheduler.retries}")
+    for cache in gptplus.caches:
+        print(f"cache {cache.name}: {cache.stats()}")
+    print(f"max RSS: {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.0f} MB (before the run {rss_before / 1024:.0f} MB)")
+    if args.metrics:
+        print_stage_metrics(gptplus.metrics)
+    if args.tracemalloc:
+        current, peak = tracemalloc.get_traced_memory()
+        print(f"python allocations: {current / 1048576:.1f} MB at the end, peak {peak / 1048576:.1f} MB")
+
+def print_stage_metrics(metrics):
+    for (name, labels), (counts, total, count) in sorted(metrics.histograms.items()):
+        unit = " tokens/s" if name == "gptplus_model_tokens_per_second" else " ms"
+        scale = 1 if unit == " tokens/s" else 1000
+        print(f"{name}{gptplus.format_metric_labels(labels)}: {count} x {total / count * scale:.1f}{unit} on average")
+    for (name, labels), value in sorted(metrics.counters.items()):
+        print(f"{name}{gptplus.format_metric_labels(labels)}: {value:g}")
+
+# cost of the instrumentation on the hot path, disabled and enabled
+def benchmark_metrics(calls):
+    for enabled in (False, True):
+        metrics = gptplus.Metrics(enabled)
+        start = time.perf_counter()
+        for _ in range(calls):
+            with metrics.span("message"):
+                metrics.inc("gptplus_tokens_total", 10, kind="prompt")
+        elapsed = time.perf_counter() - start
+        print(f"metrics {'enabled' if enabled else 'disabled'}: {elapsed / calls * 1e9:.0f} ns per span and counter")
+    start = time.perf_counter()
+    for _ in range(calls):
+        pass
+    print(f"empty loop: {(time.perf_counter() - start) / calls * 1e9:.0f} ns per iteration")
+    start = time.perf_counter()
+    text = gptplus.metrics.render()
+    print(f"/metrics rendered in {(time.perf_counter() - start) * 1000:.2f} ms ({len(text)} bytes)")
+
+# worker process of the shards benchmark: the CPU-bound part of each message read on stdin (intent scan, weather formatting, history JSON)
+def shard_worker(result_dir, repeat):
+    name = f"{os.environ['GPTPLUS_SHARD']}-{os.getpid()}"
+    weather_data = fake_weather_payload()
+    history = json.dumps([{"role": "user", "content": "What is the weather in Geneva?"}, {"role": "gpt4", "content": "It is sunny in Geneva today. " * 20}] * 10)
+    last_message_ids = {}
+    processed = 0
+    out_of_order = 0
+    open(os.path.join(result_dir, f"{name}.ready"), "w").close()
+    for line in sys.stdin.buffer:
+        message = json.loads(line)["message"]
+        chat_id = message["chat"]["id"]
+        if message["message_id"] <= last_message_ids.get(chat_id, -1):
+            out_of_order += 1
+        last_message_ids[chat_id] = message["message_id"]
+        for _ in range(repeat):
+            gptplus.plan_external_lookups(message["text"])
+            gptplus.summarize_weather(weather_data, message["text"])
+            user_messages = json.loads(history)
+            user_messages.append({"role": "user", "content": message["text"]})
+            json.dumps(user_messages)
+        processed += 1
+    with open(os.path.join(result_dir, f"{name}.json"), "w", encoding="utf-8") as f:
+        json.dump({"processed": processed, "out_of_order": out_of_order, "chats": len(last_message_ids)}, f)
+
+async def benchmark_shards(worker_counts, count, chats, repeat, restart):
+    updates = [fake_update(i, 1 + i % chats, random.choice(E2E_PROMPTS).format(city=random.choice(E2E_CITIES))) for i in range(count)]
+    baseline = None
+    for workers in worker_counts:
+        with tempfile.TemporaryDirectory() as directory:
+            command = [sys.executable, os.path.realpath(__file__), "shard-worker", "--result-dir", directory, "--repeat", str(repeat)]
+            supervisor = gptplus.ShardSupervisor(workers, gptplus.SHARDS_DRAIN_TIMEOUT, 0.1, command)
+            await supervisor.start()
+            # the start of the processes is not measured
+            while sum(name.endswith(".ready") for name in os.listdir(directory)) < workers:
+                await asyncio.sleep(0.05)
+            restart_task = None
+            start = time.perf_counter()
+            for i, update in enumerate(updates):
+                if restart and i == count // 2:
+                    restart_task = asyncio.create_task(supervisor.restart_all())
+                await supervisor.send(update["message"]["chat"]["id"], update)
+            if restart_task is not None:
+                await restart_task
+            await supervisor.stop()
+            elapsed = time.perf_counter() - start
+            results = []
+            for name in os.listdir(directory):
+                if name.endswith(".json"):
+                    with open(os.path.join(directory, name), "r", encoding="utf-8") as f:
+                        results.append(json.load(f))
+        processed = sum(result["processed"] for result in results)
+        out_of_order = sum(result["out_of_order"] for result in results)
+        baseline = baseline or (elapsed, workers)
+        print(f"{workers} workers: {count / elapsed:.0f} updates/s ({elapsed:.2f}s), speedup x{baseline[0] / elapsed:.2f} (linear x{workers / baseline[1]:.2f}), "
+              f"{processed}/{count} processed, {out_of_order} out of order, {supervisor.lost} lost, {supervisor.restarts} restarts, per worker {supervisor.forwarded}")
+    print(f"{os.cpu_count()} cores on this machine, the scaling stops at the number of cores")
+
+# worker process of the shards-e2e benchmark: the real gptplus worker (main with GPTPLUS_SHARD) pointed at the fake servers
+def shard_bot(settings_file):
+    with open(settings_file, "r", encoding="utf-8") as f:
+        settings = json.load(f)
+    point_bot_at({name: types.SimpleNamespace(url=url) for name, url in settings["upstreams"].items()})
+    gptplus.is_authorized_chat = lambda chat_id: 1 <= chat_id <= settings["chats"]
+    gptplus.HISTORY_DATABASE = settings["database"]
+    gptplus.HISTORY_FLUSH_INTERVAL = 0.2
+    gptplus.geocoding_cache.filename = os.path.join(os.path.dirname(settings["database"]), f"geocoding_cache.shard{gptplus.SHARD_INDEX}.json")
+    asyncio.run(gptplus.main())
+
+# supervisor mode end to end: the real ShardRouter sends the updates to real worker processes that answer through the fake servers,
+# each chat sends its next message once the previous one is answered, the histories show the lost and out of order messages
+async def benchmark_shards_e2e(args):
+    upstreams = await start_fake_upstreams(args)
+    point_bot_at(upstreams)
+    with tempfile.TemporaryDirectory() as directory:
+        database = os.path.join(directory, "conversation_history.sqlite3")
+        settings_file = os.path.join(directory, "settings.json")
+        with open(settings_file, "w", encoding="utf-8") as f:
+            json.dump({"upstreams": {name: upstream.url for name, upstream in upstreams.items()}, "chats": args.chats, "database": database}, f)
+        backend = gptplus.SQLiteHistoryBackend(database)
+        command = [sys.executable, os.path.realpath(__file__), "shard-bot", "--settings", settings_file]
+        supervisor = gptplus.ShardSupervisor(args.workers, gptplus.SHARDS_DRAIN_TIMEOUT, 0.1, command)
+        await supervisor.start()
+        bot = gptplus.create_bot()
+        dp = gptplus.ShardRouter(bot, supervisor)
+        sent = collections.defaultdict(list)
+        update_ids = iter(range(1, 1 << 62))
+        start = time.perf_counter()
+        try:
+            for _ in range(args.messages):
+                for chat_id in range(1, args.chats + 1):
+                    text = f"{random.choice(E2E_PROMPTS).format(city=random.choice(E2E_CITIES))} #{len(sent[chat_id])}"
+                    sent[chat_id].append(text)
+                    await dp.process_update(Update(**fake_update(next(update_ids), chat_id, text)))
+                # the round is over when every history has its answer, or after the timeout
+                deadline = time.monotonic() + args.round_timeout
+                while time.monotonic() < deadline:
+                    if all(len(backend.read(str(chat_id)) or []) >= 2 * len(sent[chat_id]) for chat_id in sent):
+                        break
+                    await asyncio.sleep(0.1)
+        finally:
+            await supervisor.stop()
+            await bot.close()
+        elapsed = time.perf_counter() - start
+        answered = 0
+        out_of_order = 0
+        for chat_id, texts in sent.items():
+            prompts = [message["content"] for message in backend.read(str(chat_id)) or [] if message["role"] == "user"]
+            answered += len(prompts)
+            out_of_order += prompts != texts[:len(prompts)]
+        backend.close()
+    count = args.chats * args.messages
+    print(f"{args.workers} workers: {count} messages of {args.chats} chats in {elapsed:.2f}s, {answered}/{count} answered, "
+          f"{out_of_order} chats out of order, {supervisor.lost} lost, {supervisor.restarts} restarts, per worker {supervisor.forwarded}")
+    for name, upstream in upstreams.items():
+        print(f"{name}: {sum(upstream.calls.values())} calls ({', '.join(f'{route} {calls}' for route, calls in sorted(upstream.calls.items()))}), {upstream.errors} injected errors")
+        await upstream.stop()
+
+# runs the fake servers until Ctrl+C so that the bot itself can be started against them
+async def serve_fakes(args):
+    ports = {"openai": args.port, "telegram": args.port + 1, "newsapi": args.port + 2, "open-meteo": args.port + 3, "coinpaprika": args.port + 4} if args.port else None
+    upstreams = await start_fake_upstreams(args, ports)
+    print(endpoints_section(upstreams))
+    try:
+        while True:
+            await asyncio.sleep(60)
+            print(", ".join(f"{name} {sum(upstream.calls.values())} calls" for name, upstream in upstreams.items()))
+    finally:
+        for upstream in upstreams.values():
+            await upstream.stop()
+
+def add_fake_upstream_arguments(parser):
+    parser.add_argument("--latency", type=float, default=0.05, help="seconds of the data APIs (news, weather, crypto)")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="share of the data API calls answered by an error")
+    parser.add_argument("--openai-latency", type=float, default=0.3, help="seconds before the first token")
+    parser.add_argument("--openai-error-rate", type=float, default=0.0)
+    parser.add_argument("--answer-tokens", type=int, default=60)
+    parser.add_argument("--tokens-per-second", type=float, default=40)
+    parser.add_argument("--image-delay", type=float, default=2.0)
+    parser.add_argument("--telegram-latency", type=float, default=0.03)
+    parser.add_argument("--telegram-error-rate", type=float, default=0.0, help="share of the Telegram calls answered by 429 Too Many Requests")
+
+def main():
+    parser = argparse.ArgumentParser(description="gptplus benchmarks")
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    streaming = subparsers.add_parser("streaming", help="concurrent OpenAI streaming against a fake server")
+    streaming.add_argument("--chats", type=int, default=10)
+    streaming.add_argument("--chunks", type=int, default=20)
+    streaming.add_argument("--chunk-delay", type=float, default=0.05)
+
+    images = subparsers.add_parser("images", help="image generation pool with duplicated prompts")
+    images.add_argument("--requests", type=int, default=20)
+    images.add_argument("--distinct", type=int, default=5)
+    images.add_argument("--image-delay", type=float, default=1.0)
+
+    history = subparsers.add_parser("history", help="conversation history storage with many users")
+    history.add_argument("--users", type=int, default=10000)
+    history.add_argument("--turns", type=int, default=2000)
+
+    http = subparsers.add_parser("http", help="new HTTP client per request against the shared pooled client")
+    http.add_argument("--requests", type=int, default=200)
+
+    intents = subparsers.add_parser("intents", help="intent detection speed and accuracy on a labeled corpus")
+    intents.add_argument("--repeat", type=int, default=1000)
+
+    weather = subparsers.add_parser("weather", help="tokens of the weather data injected in the prompt")
+    weather.add_argument("--repeat", type=int, default=1000)
+
+    telegram = subparsers.add_parser("telegram", help="Telegram API calls needed to stream one answer")
+    telegram.add_argument("--characters", type=int, default=6000)
+    telegram.add_argument("--chunk-delay", type=float, default=0.01)
+
+    logging = subparsers.add_parser("logging", help="time spent in log_message by each message")
+    logging.add_argument("--messages", type=int, default=1000)
+    logging.add_argument("--calls", type=int, default=12)
+
+    webhook = subparsers.add_parser("webhook", help="load test of the webhook mode with recorded or synthetic updates")
+    webhook.add_argument("--updates", help="file with one recorded Telegram update (JSON) per line")
+    webhook.add_argument("--url", help="webhook of a running bot, an in-process server is used by default")
+    webhook.add_argument("--secret-token", default="", help="SECRET_TOKEN of the [WEBHOOK] section of the running bot")
+    webhook.add_argument("--count", type=int, default=2000)
+    webhook.add_argument("--chats", type=int, default=50)
+    webhook.add_argument("--concurrency", type=int, default=50)
+    webhook.add_argument("--handler-delay", type=float, default=0.01)
+
+    e2e = subparsers.add_parser("e2e", help="multi-user traffic through handle_message against fake OpenAI, Telegram and data APIs")
+    e2e.add_argument("--users", type=int, default=20)
+    e2e.add_argument("--messages", type=int, default=5, help="messages sent by each user")
+    e2e.add_argument("--think-time", type=float, default=1.0, help="mean seconds between the answer and the next message of a user")
+    e2e.add_argument("--image-rate", type=float, default=0.05, help="share of the messages asking for an image")
+    e2e.add_argument("--tracemalloc", action="store_true", help="also report the python allocations (slower)")
+    e2e.add_argument("--metrics", action="store_true", help="also report the time spent in each stage of the pipeline")
+    add_fake_upstream_arguments(e2e)
+
+    metrics = subparsers.add_parser("metrics", help="overhead of the spans and counters, disabled and enabled")
+    metrics.add_argument("--calls", type=int, default=1000000)
+
+    shards = subparsers.add_parser("shards", help="throughput of the supervisor mode with more and more worker processes")
+    shards.add_argument("--workers", default="1,2,4", help="comma-separated numbers of workers")
+    shards.add_argument("--updates", type=int, default=4000)
+    shards.add_argument("--chats", type=int, default=200)
+    shards.add_argument("--repeat", type=int, default=3, help="times the CPU-bound work is done for each message")
+    shards.add_argument("--restart", action="store_true", help="restart all the workers one after the other in the middle of the run")
+
+    shards_e2e = subparsers.add_parser("shards-e2e", help="supervisor mode with real worker processes against fake OpenAI, Telegram and data APIs")
+    shards_e2e.add_argument("--workers", type=int, default=2)
+    shards_e2e.add_argument("--chats", type=int, default=20)
+    shards_e2e.add_argument("--messages", type=int, default=3, help="messages sent by each chat, the next one once the previous one is answered")
+    shards_e2e.add_argument("--round-timeout", type=float, default=60, help="seconds to wait for the answers of a round")
+    add_fake_upstream_arguments(shards_e2e)
+
+    shard_bot_parser = subparsers.add_parser("shard-bot", help="worker process started by the shards-e2e benchmark")
+    shard_bot_parser.add_argument("--settings", required=True)
+
+    shard_worker_parser = subparsers.add_parser("shard-worker", help="worker process started by the shards benchmark")
+    shard_worker_parser.add_argument("--result-dir", required=True)
+    shard_worker_parser.add_argument("--repeat", type=int, default=3)
+
+    fakes = subparsers.add_parser("fakes", help="only run the fake servers, for the bot started with the printed [ENDPOINTS] section")
+    fakes.add_argument("--port", type=int, default=0, help="first of 5 consecutive ports, random ports by default")
+    add_fake_upstream_arguments(fakes)
+
+    args = parser.parse_args()
+    if args.benchmark == "streaming":
+        asyncio.run(benchmark_streaming(args.chats, args.chunks, args.chunk_delay))
+    elif args.benchmark == "images":
+        asyncio.run(benchmark_images(args.requests, args.distinct, args.image_delay))
+    elif args.benchmark == "history":
+        asyncio.run(benchmark_history(args.users, args.turns))
+    elif args.benchmark == "http":
+        asyncio.run(benchmark_http(args.requests))
+    elif args.benchmark == "intents":
+        benchmark_intents(args.repeat)
+    elif args.benchmark == "weather":
+        benchmark_weather(args.repeat)
+    elif args.benchmark == "telegram":
+        asyncio.run(benchmark_telegram(args.characters, args.chunk_delay))
+    elif args.benchmark == "logging":
+        benchmark_logging(args.messages, args.calls)
+    elif args.benchmark == "webhook":
+        asyncio.run(benchmark_webhook(args.updates, args.url, args.secret_token, args.count, args.chats, args.concurrency, args.handler_delay))
+    elif args.benchmark == "e2e":
+        asyncio.run(benchmark_e2e(args))
+    elif args.benchmark == "metrics":
+        benchmark_metrics(args.calls)
+    elif args.benchmark == "shards":
+        asyncio.run(benchmark_shards([int(workers) for workers in args.workers.split(",")], args.updates, args.chats, args.repeat, args.restart))
+    elif args.benchmark == "shard-worker":
+        shard_worker(args.result_dir, args.repeat)
+    elif args.benchmark == "shards-e2e":
+        asyncio.run(benchmark_shards_e2e(args))
+    elif args.benchmark == "shard-bot":
+        shard_bot(args.settings)
+    elif args.benchmark == "fakes":
+        asyncio.run(serve_fakes(args))
+
+if __name__ == '__main__':
+    main()
@@ -14,9 +14,6 @@
 #
 # A améliorer :
 * NONE
-#
-# NICE-TO-HAVE FEATURES:
-* Implementation of OpenAI's tiktoken to count the used tokens: https://github.com/openai/tiktoken + logs the price of the generated images too
 '''
 import asyncio
 import openai
@@ -25,13 +22,32 @@ import httpx
 import aiohttp
 from aiogram import Bot, Dispatcher, types
 from aiogram.contrib.middlewares.logging import LoggingMiddleware
-from aiogram.utils.exceptions import RetryAfter, TelegramAPIError
-from aiohttp import ClientSession
+from aiogram.bot.api import TelegramAPIServer, TELEGRAM_PRODUCTION
+from aiohttp import web
+from aiogram.utils.exceptions import RetryAfter, TelegramAPIError, MessageNotModified
 from typing import Tuple, Optional
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
 import re
 import datetime
 import configparser
 import os
+import sys
+import time
+import collections
+import sqlite3
+import threading
+import queue
+import atexit
+import signal
+import random
+import hmac
+import secrets
+import hashlib
+import bisect
+import contextlib
 
 script_dir = os.path.dirname(os.path.realpath(__file__))
 os.chdir(script_dir)
@@ -41,101 +57,927 @@ config = configparser.ConfigParser()
 # Please edit the INI file with personal information (check comments in INI file)
 config.read(config_path)
 
+# index of the process in the supervisor mode, set by the front process in the environment of its workers
+SHARD_INDEX = int(os.environ["GPTPLUS_SHARD"]) if os.environ.get("GPTPLUS_SHARD") else None
+
+def shard_filename(filename):
+    # each worker writes its own log and cache files
+    if SHARD_INDEX is None or not filename:
+        return filename
+    root, extension = os.path.splitext(filename)
+    return f"{root}.shard{SHARD_INDEX}{extension}"
+
 # KEYs from the INI file
 API_KEY = config['KEYS']['OPENAI_API_KEY']
 openai.api_key = API_KEY
 TELEGRAM_BOT_TOKEN = config['KEYS']['TELEGRAM_BOT_TOKEN']
 CHAT_ID = config['KEYS']['CHAT_ID']
+# only this chat can use the bot and your API key
+AUTHORIZED_CHAT_ID = int(CHAT_ID) if CHAT_ID.strip() else None
+
+def is_authorized_chat(chat_id):
+    return chat_id == AUTHORIZED_CHAT_ID
 NEWSAPI_KEY = config['KEYS']['NEWSAPI_KEY']
 
-# function to display a log message with a time stamp
-def log_message(message):
-    with open("log-gptplus.txt", "a", encoding='utf-8') as log_file:
-        log_file.write(f"{datetime.datetime.now()} - {message}\n")
+# base urls of the APIs (the [ENDPOINTS] section is optional), changed to run the bot against local fake servers
+OPENAI_BASE_URL = config.get('ENDPOINTS', 'OPENAI', fallback='')
+if OPENAI_BASE_URL:
+    openai.api_base = OPENAI_BASE_URL
+TELEGRAM_BASE_URL = config.get('ENDPOINTS', 'TELEGRAM', fallback='')
+NEWSAPI_BASE_URL = config.get('ENDPOINTS', 'NEWSAPI', fallback='https://newsapi.org')
+GEOCODING_BASE_URL = config.get('ENDPOINTS', 'GEOCODING', fallback='https://geocoding-api.open-meteo.com')
+WEATHER_BASE_URL = config.get('ENDPOINTS', 'WEATHER', fallback='https://api.open-meteo.com')
+COINPAPRIKA_BASE_URL = config.get('ENDPOINTS', 'COINPAPRIKA', fallback='https://api.coinpaprika.com')
 
-def save_conversation_history(user_id, user_messages, filename="conversation_history.json"):
-    try:
-        with open(filename, "a+", encoding="utf-8") as f:  
-            # rewind the file to the beginning to read its content
-            f.seek(0)  
+# connection pool used by the asynchronous OpenAI client (the [OPENAI] section is optional)
+OPENAI_MAX_CONNECTIONS = config.getint('OPENAI', 'MAX_CONNECTIONS', fallback=20)
+OPENAI_KEEPALIVE_TIMEOUT = config.getfloat('OPENAI', 'KEEPALIVE_TIMEOUT', fallback=60)
+OPENAI_MODEL = config.get('OPENAI', 'MODEL', fallback='gpt-4')
+# tokens of the history, external data and question sent to the model, and tokens of the answer
+OPENAI_CONTEXT_BUDGET = config.getint('OPENAI', 'CONTEXT_BUDGET', fallback=6000)
+OPENAI_MAX_RESPONSE_TOKENS = config.getint('OPENAI', 'MAX_RESPONSE_TOKENS', fallback=2000)
+# prices in dollars per 1000 tokens and per 1024x1024 image, used for the cost in the logs
+OPENAI_PROMPT_PRICE = config.getfloat('OPENAI', 'PROMPT_PRICE', fallback=0.03)
+OPENAI_COMPLETION_PRICE = config.getfloat('OPENAI', 'COMPLETION_PRICE', fallback=0.06)
+OPENAI_IMAGE_PRICE = config.getfloat('OPENAI', 'IMAGE_PRICE', fallback=0.02)
+
+# image generation workers (the [IMAGES] section is optional)
+IMAGE_WORKERS = config.getint('IMAGES', 'WORKERS', fallback=2)
+IMAGE_QUEUE_SIZE = config.getint('IMAGES', 'QUEUE_SIZE', fallback=20)
+IMAGE_CACHE_TTL = config.getint('IMAGES', 'CACHE_TTL', fallback=1800)
+
+# conversation history storage (the [HISTORY] section is optional), BACKEND is sqlite or json
+HISTORY_BACKEND = config.get('HISTORY', 'BACKEND', fallback='sqlite')
+HISTORY_DATABASE = config.get('HISTORY', 'DATABASE', fallback='conversation_history.sqlite3')
+HISTORY_JSON_FILE = config.get('HISTORY', 'JSON_FILE', fallback='conversation_history.json')
+HISTORY_CACHE_SIZE = config.getint('HISTORY', 'CACHE_SIZE', fallback=1000)
+HISTORY_FLUSH_INTERVAL = config.getfloat('HISTORY', 'FLUSH_INTERVAL', fallback=2)
+HISTORY_MAX_MESSAGES = config.getint('HISTORY', 'MAX_MESSAGES', fallback=20)
+
+# shared HTTP client used for the news, weather and crypto APIs (the [HTTP] section is optional)
+HTTP_MAX_CONNECTIONS = config.getint('HTTP', 'MAX_CONNECTIONS', fallback=50)
+HTTP_MAX_CONNECTIONS_PER_HOST = config.getint('HTTP', 'MAX_CONNECTIONS_PER_HOST', fallback=10)
+HTTP_KEEPALIVE_EXPIRY = config.getfloat('HTTP', 'KEEPALIVE_EXPIRY', fallback=60)
+HTTP_TIMEOUT = config.getfloat('HTTP', 'TIMEOUT', fallback=10)
+HTTP_CONNECT_TIMEOUT = config.getfloat('HTTP', 'CONNECT_TIMEOUT', fallback=5)
+HTTP_HTTP2 = config.getboolean('HTTP', 'HTTP2', fallback=False)
+
+# time to live in seconds of the cached external data (the [CACHE] section is optional)
+CACHE_GEOCODING_TTL = config.getint('CACHE', 'GEOCODING_TTL', fallback=30 * 24 * 3600)
+CACHE_WEATHER_TTL = config.getint('CACHE', 'WEATHER_TTL', fallback=900)
+CACHE_NEWS_TTL = config.getint('CACHE', 'NEWS_TTL', fallback=600)
+CACHE_CRYPTO_TTL = config.getint('CACHE', 'CRYPTO_TTL', fallback=60)
+CACHE_MAX_SIZE = config.getint('CACHE', 'MAX_SIZE', fallback=500)
+# the geocodes are saved in this file to survive a restart, empty to disable
+CACHE_GEOCODING_FILE = shard_filename(config.get('CACHE', 'GEOCODING_FILE', fallback='geocoding_cache.json'))
+# seconds an expired weather, news or crypto value is still served while it is fetched again in the background,
+# only when the background refresh is enabled, otherwise the first question after an idle period would get old prices
+CACHE_STALE_TTL = config.getint('CACHE', 'STALE_TTL', fallback=600)
+
+# background refresh of the hot data (the [REFRESH] section is optional), disabled by default, an interval of 0 disables a source
+# only the keys asked within the last IDLE_TIMEOUT seconds are refreshed, nothing is fetched while nobody uses the bot
+REFRESH_ENABLED = config.getboolean('REFRESH', 'ENABLED', fallback=False)
+REFRESH_IDLE_TIMEOUT = config.getfloat('REFRESH', 'IDLE_TIMEOUT', fallback=1800)
+# at most 4 news categories every hour (96 requests a day) to stay within the 100 requests a day of the free NewsAPI plan
+REFRESH_NEWS_INTERVAL = config.getfloat('REFRESH', 'NEWS_INTERVAL', fallback=3600)
+REFRESH_CRYPTO_INTERVAL = config.getfloat('REFRESH', 'CRYPTO_INTERVAL', fallback=300)
+REFRESH_WEATHER_INTERVAL = config.getfloat('REFRESH', 'WEATHER_INTERVAL', fallback=840)
+REFRESH_NEWS_CATEGORIES = [category.strip() for category in config.get('REFRESH', 'NEWS_CATEGORIES', fallback='monde, france, suisse, usa').split(',') if category.strip()]
+REFRESH_HOT_CITIES = config.getint('REFRESH', 'HOT_CITIES', fallback=5)
+REFRESH_JITTER = config.getfloat('REFRESH', 'JITTER', fallback=0.1)
+REFRESH_MIN_REQUEST_INTERVAL = config.getfloat('REFRESH', 'MIN_REQUEST_INTERVAL', fallback=1)
+
+# followed cryptos: "coinpaprika id: alias, alias; ...", the tickers of all of them are refreshed with one request when the crypto cache expires
+CRYPTO_COINS = config.get('CRYPTO', 'COINS', fallback='btc-bitcoin: bitcoin, btc; eth-ethereum: ethereum, eth; avax-avalanche: avax; xmr-monero: monero, xmr')
+
+# answers to the weather, news and crypto questions reused while their data is unchanged, disabled by default
+RESPONSE_CACHE_ENABLED = config.getboolean('CACHE', 'RESPONSES', fallback=False)
+RESPONSE_CACHE_MAX_SIZE = config.getint('CACHE', 'RESPONSES_MAX_SIZE', fallback=200)
+
+# seconds the external data fetched concurrently for a prompt is waited for (the [EXTERNAL_DATA] section is optional)
+EXTERNAL_DATA_DEADLINE = config.getfloat('EXTERNAL_DATA', 'DEADLINE', fallback=8)
+
+# streaming of the answers in Telegram (the [TELEGRAM] section is optional)
+# seconds between two edits of the message being streamed, and between two API calls for the same chat
+TELEGRAM_FLUSH_INTERVAL = config.getfloat('TELEGRAM', 'FLUSH_INTERVAL', fallback=1.5)
+TELEGRAM_CHAT_INTERVAL = config.getfloat('TELEGRAM', 'CHAT_INTERVAL', fallback=1.0)
+TELEGRAM_MESSAGE_LIMIT = 4096
+
+# log file (the [LOG] section is optional), rotated when it is bigger than MAX_BYTES or older than ROTATE_INTERVAL seconds
+LOG_FILE = shard_filename(config.get('LOG', 'FILE', fallback='log-gptplus.txt'))
+LOG_LEVELS = {"DEBUG": 10, "INFO": 20, "WARNING": 30, "ERROR": 40, "CRITICAL": 50}
+LOG_LEVEL_NAME = config.get('LOG', 'LEVEL', fallback='INFO').upper()
+if LOG_LEVEL_NAME not in LOG_LEVELS:
+    raise ValueError(f"Unknown LEVEL '{LOG_LEVEL_NAME}' in the [LOG] section of config.ini, use one of {', '.join(LOG_LEVELS)}")
+LOG_LEVEL = LOG_LEVELS[LOG_LEVEL_NAME]
+LOG_MAX_BYTES = config.getint('LOG', 'MAX_BYTES', fallback=10 * 1024 * 1024)
+LOG_ROTATE_INTERVAL = config.getint('LOG', 'ROTATE_INTERVAL', fallback=7 * 24 * 3600)
+LOG_BACKUP_COUNT = config.getint('LOG', 'BACKUP_COUNT', fallback=5)
+# maximum number of characters of a message or field, the rest is cut
+LOG_MAX_PAYLOAD = config.getint('LOG', 'MAX_PAYLOAD', fallback=1000)
+# the aiogram logging middleware logs every update, only useful to debug
+LOG_AIOGRAM_MIDDLEWARE = config.getboolean('LOG', 'AIOGRAM_MIDDLEWARE', fallback=False)
+
+# how the updates are received: polling (default) or webhook
+TELEGRAM_MODE = config.get('TELEGRAM', 'MODE', fallback='polling')
+
+# webhook mode (the [WEBHOOK] section is optional), URL is the public https address Telegram posts the updates to
+WEBHOOK_URL = config.get('WEBHOOK', 'URL', fallback='')
+# set_webhook with an empty url removes the webhook, the bot would then never receive an update
+if TELEGRAM_MODE == "webhook" and not WEBHOOK_URL:
+    raise ValueError("MODE = webhook in the [TELEGRAM] section of config.ini needs the public URL of the [WEBHOOK] section")
+WEBHOOK_HOST = config.get('WEBHOOK', 'HOST', fallback='0.0.0.0')
+WEBHOOK_PORT = config.getint('WEBHOOK', 'PORT', fallback=8080)
+WEBHOOK_PATH = config.get('WEBHOOK', 'PATH', fallback='/webhook')
+# the updates only come from Telegram when they carry the secret, without one in config.ini a random secret is given to set_webhook
+WEBHOOK_SECRET_TOKEN = config.get('WEBHOOK', 'SECRET_TOKEN', fallback='') or secrets.token_urlsafe(32)
+# updates waiting to be processed before Telegram is asked to retry later, and number of updates processed at the same time
+WEBHOOK_QUEUE_SIZE = config.getint('WEBHOOK', 'QUEUE_SIZE', fallback=100)
+WEBHOOK_WORKERS = config.getint('WEBHOOK', 'WORKERS', fallback=10)
+WEBHOOK_DRAIN_TIMEOUT = config.getfloat('WEBHOOK', 'DRAIN_TIMEOUT', fallback=30)
+
+# supervisor mode (the [SHARDS] section is optional): with more than one worker, a front process receives the updates
+# and sends those of each chat to the same worker process, 0 or 1 runs everything in one process
+SHARDS_WORKERS = config.getint('SHARDS', 'WORKERS', fallback=0)
+SHARDS_DRAIN_TIMEOUT = config.getfloat('SHARDS', 'DRAIN_TIMEOUT', fallback=30)
+SHARDS_RESTART_DELAY = config.getfloat('SHARDS', 'RESTART_DELAY', fallback=1)
+
+# scheduling of the messages (the [SCHEDULER] section is optional)
+SCHEDULER_MAX_MODEL_CALLS = config.getint('SCHEDULER', 'MAX_MODEL_CALLS', fallback=5)
+SCHEDULER_MAX_RETRIES = config.getint('SCHEDULER', 'MAX_RETRIES', fallback=3)
+SCHEDULER_RETRY_DELAY = config.getfloat('SCHEDULER', 'RETRY_DELAY', fallback=1)
+SCHEDULER_RETRY_JITTER = config.getfloat('SCHEDULER', 'RETRY_JITTER', fallback=0.5)
+
+# metrics of the message pipeline (the [METRICS] section is optional), served on http://HOST:PORT/metrics
+METRICS_ENABLED = config.getboolean('METRICS', 'ENABLED', fallback=False)
+METRICS_HOST = config.get('METRICS', 'HOST', fallback='127.0.0.1')
+METRICS_PORT = config.getint('METRICS', 'PORT', fallback=9108)
+# spans exported with OpenTelemetry when the opentelemetry-sdk package is installed
+METRICS_OPENTELEMETRY = config.getboolean('METRICS', 'OPENTELEMETRY', fallback=False)
+METRICS_OTLP_ENDPOINT = config.get('METRICS', 'OTLP_ENDPOINT', fallback='')
+
+# answers that are still streaming, by (chat id, user id) like the history, so that a new message of the same user can cancel them
+active_responses = {}
+
+# JSON lines log written in batches by a background thread, so that logging never blocks the event loop
+class LogWriter:
+    def __init__(self, filename, max_bytes, rotate_interval, backup_count, batch_size=500):
+        self.filename = filename
+        self.max_bytes = max_bytes
+        self.rotate_interval = rotate_interval
+        self.backup_count = backup_count
+        self.batch_size = batch_size
+        self.queue = queue.SimpleQueue()
+        self.file = None
+        self.opened_at = 0.0
+        # batches that could not be written, reported on stderr since the log itself is failing
+        self.dropped_batches = 0
+        self.dropped_records = 0
+        self.thread = threading.Thread(target=self.run, name="gptplus-log", daemon=True)
+        self.thread.start()
+
+    def write(self, record):
+        self.queue.put(record)
+
+    def open(self):
+        self.file = open(self.filename, "a", encoding="utf-8")
+        self.opened_at = time.time()
+
+    def rotate(self):
+        self.file.close()  # type: ignore
+        for index in range(self.backup_count - 1, 0, -1):
+            if os.path.exists(f"{self.filename}.{index}"):
+                os.replace(f"{self.filename}.{index}", f"{self.filename}.{index + 1}")
+        if self.backup_count > 0:
+            os.replace(self.filename, f"{self.filename}.1")
+        else:
+            os.remove(self.filename)
+        self.open()
+
+    def run(self):
+        self.open()
+        running = True
+        while running:
+            batch = [self.queue.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            # None is queued by close() to stop the thread
+            running = None not in batch
+            lines = []
+            for record in batch:
+                if record is not None:
+                    record["time"] = datetime.datetime.fromtimestamp(record["time"]).isoformat()
+                    lines.append(json.dumps(record, ensure_ascii=False, default=str) + "\n")
+            data = "".join(lines)
             try:
-                all_conversations = json.load(f)
-            except json.JSONDecodeError:
-                log_message(f"The file {filename} is empty or corrupted. Creation of a new dictionary.")
-                all_conversations = {}
-    except Exception as e:
-        log_message(f"Error while recording conversations : {e}")
-        # add this line to handle unexpected errors
-        all_conversations = {}  
+                too_big = self.max_bytes and self.file.tell() + len(data) > self.max_bytes  # type: ignore
+                too_old = self.rotate_interval and time.time() - self.opened_at > self.rotate_interval
+                if (too_big or too_old) and self.file.tell():  # type: ignore
+                    self.rotate()
+                self.file.write(data)  # type: ignore
+                self.file.flush()  # type: ignore
+            except (OSError, ValueError) as e:
+                self.dropped_batches += 1
+                self.dropped_records += len(lines)
+                print(f"Error while writing the log file {self.filename}, {self.dropped_records} records dropped in {self.dropped_batches} batches: {e}", file=sys.stderr)
+                # a rotation that failed halfway leaves the file closed
+                if self.file.closed:  # type: ignore
+                    try:
+                        self.open()
+                    except OSError:
+                        pass
+        self.file.close()  # type: ignore
+
+    def close(self):
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join(timeout=5)
+
+log_writer = LogWriter(LOG_FILE, LOG_MAX_BYTES, LOG_ROTATE_INTERVAL, LOG_BACKUP_COUNT)
+# the last messages are written when the script stops
+atexit.register(log_writer.close)
+
+def cap_payload(value):
+    text = value if isinstance(value, str) else str(value)
+    if len(text) > LOG_MAX_PAYLOAD:
+        return f"{text[:LOG_MAX_PAYLOAD]}... ({len(text)} characters)"
+    return text
+
+# function to log a message with a time stamp, a level and optional structured fields
+def log_message(message, level="INFO", **fields):
+    if LOG_LEVELS[level] < LOG_LEVEL:
+        return
+    record = {"time": time.time(), "level": level, "message": cap_payload(message)}
+    for key, value in fields.items():
+        record[key] = value if isinstance(value, (int, float, bool)) or value is None else cap_payload(value)
+    log_writer.write(record)
+
+# buckets in seconds of the timers, and of the generation speed in tokens per second
+METRICS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+METRICS_RATE_BUCKETS = (1, 2, 5, 10, 20, 40, 80, 160)
+# control flow exceptions handled by the callers, not counted as errors of the stage
+METRICS_EXPECTED_EXCEPTIONS = (asyncio.CancelledError, RetryAfter, MessageNotModified)
+
+# timer of one stage of the pipeline, also an OpenTelemetry span when a tracer is configured
+class Span:
+    __slots__ = ("metrics", "stage", "otel_span", "start")
+
+    def __init__(self, metrics, stage, otel_span):
+        self.metrics = metrics
+        self.stage = stage
+        self.otel_span = otel_span
 
-    # memory management - keeps only the last 6 messages (3 from the user and 3 from the assistant)
-    user_messages = user_messages[-6:]  
-    all_conversations[str(user_id)] = user_messages
+    def __enter__(self):
+        if self.otel_span is not None:
+            self.otel_span.__enter__()
+        self.start = time.perf_counter()
+        return self
 
-    with open(filename, "w", encoding="utf-8") as f:
-        json.dump(all_conversations, f, ensure_ascii=False, indent=4)
+    def __exit__(self, exc_type, exc, traceback):
+        self.metrics.observe("gptplus_stage_seconds", time.perf_counter() - self.start, stage=self.stage)
+        if exc_type is not None and not issubclass(exc_type, METRICS_EXPECTED_EXCEPTIONS):
+            self.metrics.inc("gptplus_errors_total", stage=self.stage)
+        if self.otel_span is not None:
+            self.otel_span.__exit__(exc_type, exc, traceback)
+        return False
+
+# counters and histograms in memory, rendered in the Prometheus text format
+# when disabled, the counters return at once and span() returns a shared context manager that does nothing
+class Metrics:
+    def __init__(self, enabled=False, tracer=None):
+        self.enabled = enabled
+        self.tracer = tracer
+        self.null_span = contextlib.nullcontext()
+        # (name, labels) -> value, and (name, labels) -> [bucket counts, sum, count]
+        self.counters = collections.Counter()
+        self.histograms = {}
+        self.buckets = {"gptplus_model_tokens_per_second": METRICS_RATE_BUCKETS}
+        # functions returning (name, type, labels, value) of the values read when /metrics is called
+        self.collectors = []
+
+    def inc(self, name, value=1, **labels):
+        if self.enabled:
+            self.counters[(name, tuple(sorted(labels.items())))] += value
+
+    def observe(self, name, value, **labels):
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            histogram = self.histograms[key] = [[0] * (len(self.buckets.get(name, METRICS_BUCKETS)) + 1), 0.0, 0]
+        histogram[0][bisect.bisect_left(self.buckets.get(name, METRICS_BUCKETS), value)] += 1
+        histogram[1] += value
+        histogram[2] += 1
+
+    def span(self, stage, **attributes):
+        if not self.enabled and self.tracer is None:
+            return self.null_span
+        otel_span = self.tracer.start_as_current_span(stage, attributes=attributes) if self.tracer is not None else None
+        return Span(self, stage, otel_span)
+
+    def render(self):
+        families = collections.defaultdict(list)
+        kinds = {}
+        for (name, labels), value in self.counters.items():
+            kinds[name] = "counter"
+            families[name].append(f"{name}{format_metric_labels(labels)} {float(value)!r}")
+        for (name, labels), (counts, total, count) in self.histograms.items():
+            kinds[name] = "histogram"
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets.get(name, METRICS_BUCKETS) + (float("inf"),), counts):
+                cumulative += bucket_count
+                le = "+Inf" if bound == float("inf") else f"{bound:g}"
+                families[name].append(f"{name}_bucket{format_metric_labels(labels + (('le', le),))} {cumulative}")
+            families[name].append(f"{name}_sum{format_metric_labels(labels)} {float(total)!r}")
+            families[name].append(f"{name}_count{format_metric_labels(labels)} {count}")
+        for collector in self.collectors:
+            for name, kind, labels, value in collector():
+                kinds[name] = kind
+                families[name].append(f"{name}{format_metric_labels(tuple(sorted(labels.items())))} {float(value)!r}")
+        return "".join(f"# TYPE {name} {kinds[name]}\n" + "\n".join(lines) + "\n" for name, lines in families.items())
+
+def format_metric_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{escape_metric_label(value)}"' for key, value in labels) + "}"
+
+def escape_metric_label(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
 
-def load_conversation_history(user_id, filename="conversation_history.json"):
+metrics = Metrics(METRICS_ENABLED)
+
+# OpenTelemetry tracer exporting the spans with OTLP over HTTP, or to the console without the OTLP exporter
+def create_tracer():
     try:
-        with open(filename, "r", encoding="utf-8") as f:
-            all_conversations = json.load(f)
-            return all_conversations.get(str(user_id), [])
-    except FileNotFoundError:
-        log_message(f"Erreur : Fichier {filename} introuvable")
-        with open(filename, "w", encoding="utf-8") as f:
-            json.dump({}, f, ensure_ascii=False, indent=4)
-        return []
-    
-def reset_conversation_history(user_id, filename="conversation_history.json"):
+        from opentelemetry import trace
+        from opentelemetry.sdk.resources import Resource
+        from opentelemetry.sdk.trace import TracerProvider
+        from opentelemetry.sdk.trace.export import BatchSpanProcessor, ConsoleSpanExporter
+    except ImportError:
+        log_message("OPENTELEMETRY is enabled in the [METRICS] section but the opentelemetry-sdk package is not installed", level="WARNING")
+        return None
     try:
-        with open(filename, "r+", encoding="utf-8") as f:
-            all_conversations = json.load(f)
-            if str(user_id) in all_conversations:
-                all_conversations[str(user_id)] = []
-                f.seek(0)
+        from opentelemetry.exporter.otlp.proto.http.trace_exporter import OTLPSpanExporter
+        exporter = OTLPSpanExporter(endpoint=METRICS_OTLP_ENDPOINT) if METRICS_OTLP_ENDPOINT else OTLPSpanExporter()
+    except ImportError:
+        exporter = ConsoleSpanExporter()
+    provider = TracerProvider(resource=Resource.create({"service.name": "gptplus"}))
+    provider.add_span_processor(BatchSpanProcessor(exporter))
+    trace.set_tracer_provider(provider)
+    return trace.get_tracer("gptplus")
+
+def shutdown_tracer():
+    if metrics.tracer is not None:
+        from opentelemetry import trace
+        trace.get_tracer_provider().shutdown()  # type: ignore
+
+async def start_metrics_server(host, port):
+    async def serve_metrics(request):
+        return web.Response(text=metrics.render(), content_type="text/plain", charset="utf-8", headers={"X-Content-Type-Options": "nosniff"})
+
+    app = web.Application()
+    app.router.add_get("/metrics", serve_metrics)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    log_message(f"Metrics served on http://{host}:{port}/metrics")
+    return runner
+
+# history backend storing the whole history in one JSON file (format of the previous versions)
+class JSONHistoryBackend:
+    def __init__(self, filename):
+        self.filename = filename
+        self.lock = threading.Lock()
+
+    def read_all(self):
+        try:
+            with open(self.filename, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+        except json.JSONDecodeError:
+            log_message(f"The file {self.filename} is empty or corrupted. Creation of a new dictionary.")
+            return {}
+
+    def read(self, user_id):
+        with self.lock:
+            return self.read_all().get(user_id)
+
+    def write_many(self, conversations):
+        # one rewrite of the file for the whole batch instead of one per message
+        with self.lock:
+            all_conversations = self.read_all()
+            all_conversations.update(conversations)
+            with open(self.filename, "w", encoding="utf-8") as f:
                 json.dump(all_conversations, f, ensure_ascii=False, indent=4)
-                f.truncate()
-                return True
-            else:
-                return False
-    except FileNotFoundError:
-        log_message(f"Error: File {filename} not found")
-        return False
+
+    def is_empty(self):
+        with self.lock:
+            return not self.read_all()
+
+    def close(self):
+        pass
+
+# history backend storing one row per user in SQLite, in WAL mode so that reads never wait for writes
+class SQLiteHistoryBackend:
+    def __init__(self, filename):
+        self.filename = filename
+        self.lock = threading.Lock()
+        # writes are made from a worker thread, the lock serializes the access to the connection
+        self.connection = sqlite3.connect(filename, check_same_thread=False, isolation_level=None)
+        with self.lock:
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute("PRAGMA synchronous=NORMAL")
+            self.connection.execute("CREATE TABLE IF NOT EXISTS conversations (user_id TEXT PRIMARY KEY, messages TEXT NOT NULL)")
+
+    def read(self, user_id):
+        with self.lock:
+            row = self.connection.execute("SELECT messages FROM conversations WHERE user_id = ?", (user_id,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def write_many(self, conversations):
+        rows = [(user_id, json.dumps(messages, ensure_ascii=False)) for user_id, messages in conversations.items()]
+        with self.lock:
+            self.connection.execute("BEGIN")
+            try:
+                self.connection.executemany("INSERT INTO conversations (user_id, messages) VALUES (?, ?) ON CONFLICT(user_id) DO UPDATE SET messages = excluded.messages", rows)
+                self.connection.execute("COMMIT")
+            except Exception:
+                self.connection.execute("ROLLBACK")
+                raise
+
+    def is_empty(self):
+        with self.lock:
+            return self.connection.execute("SELECT 1 FROM conversations LIMIT 1").fetchone() is None
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+# conversations in front of a backend: LRU of the hot conversations and write-behind batching of the saves
+class ConversationHistoryStore:
+    def __init__(self, backend, cache_size=1000, flush_interval=2.0):
+        self.backend = backend
+        self.cache_size = cache_size
+        self.flush_interval = flush_interval
+        self.cache = collections.OrderedDict()
+        # saves not written yet, and the batch being written by the worker thread
+        self.pending = {}
+        self.flushing = {}
+        self.flush_task = None
+
+    def remember(self, user_id, user_messages):
+        self.cache[user_id] = user_messages
+        self.cache.move_to_end(user_id)
+        while len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+
+    def lookup(self, user_id):
+        for source in (self.pending, self.flushing):
+            if user_id in source:
+                return source[user_id]
+        if user_id in self.cache:
+            self.cache.move_to_end(user_id)
+            return self.cache[user_id]
+        user_messages = self.backend.read(user_id)
+        if user_messages is not None:
+            self.remember(user_id, user_messages)
+        return user_messages
+
+    def load(self, user_id):
+        return list(self.lookup(str(user_id)) or [])
+
+    def save(self, user_id, user_messages):
+        user_id = str(user_id)
+        user_messages = list(user_messages)
+        self.pending[user_id] = user_messages
+        self.remember(user_id, user_messages)
+        # without the background flush (outside of main), the save is written immediately
+        if self.flush_task is None:
+            self.flush_now()
+
+    def reset(self, user_id):
+        if self.lookup(str(user_id)) is None:
+            return False
+        self.save(user_id, [])
+        return True
+
+    def flush_now(self):
+        batch, self.pending = self.pending, {}
+        if batch:
+            self.backend.write_many(batch)
+
+    async def flush(self):
+        if not self.pending:
+            return
+        self.flushing, self.pending = self.pending, {}
+        try:
+            await asyncio.to_thread(self.backend.write_many, self.flushing)
+        except Exception as e:
+            log_message(f"Error while recording conversations : {e}", level="ERROR")
+            # keep the failed saves for the next flush unless a newer save exists
+            for user_id, user_messages in self.flushing.items():
+                self.pending.setdefault(user_id, user_messages)
+        finally:
+            self.flushing = {}
+
+    async def flush_periodically(self):
+        while not self.closing.is_set():
+            try:
+                await asyncio.wait_for(self.closing.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            await self.flush()
+
+    def start(self):
+        self.closing = asyncio.Event()
+        self.flush_task = asyncio.create_task(self.flush_periodically())
+
+    async def close(self):
+        if self.flush_task is not None:
+            # let the running flush finish instead of cancelling it in the middle of a write
+            self.closing.set()
+            await self.flush_task
+            self.flush_task = None
+        await self.flush()
+        self.backend.close()
+
+# one-shot import of the conversation_history.json file of the previous versions
+def migrate_json_history(backend, filename):
+    if isinstance(backend, JSONHistoryBackend) or not os.path.exists(filename) or not backend.is_empty():
+        return 0
+    all_conversations = JSONHistoryBackend(filename).read_all()
+    if all_conversations:
+        backend.write_many({str(user_id): user_messages for user_id, user_messages in all_conversations.items()})
+    os.replace(filename, filename + ".migrated")
+    log_message(f"{len(all_conversations)} conversations migrated from {filename} to {backend.filename}")
+    return len(all_conversations)
+
+def create_history_store():
+    if HISTORY_BACKEND == "json":
+        backend = JSONHistoryBackend(HISTORY_JSON_FILE)
+    else:
+        backend = SQLiteHistoryBackend(HISTORY_DATABASE)
+        # the workers of the supervisor mode share the database, the front process migrates it once before starting them
+        if SHARD_INDEX is None:
+            migrate_json_history(backend, HISTORY_JSON_FILE)
+    return ConversationHistoryStore(backend, HISTORY_CACHE_SIZE, HISTORY_FLUSH_INTERVAL)
+
+# created by main()
+conversation_store = None
+
+def save_conversation_history(user_id, user_messages):
+    # memory management - keeps only the last messages, the context sent to the model is then cut to its token budget
+    user_messages = user_messages[-HISTORY_MAX_MESSAGES:]  
+    conversation_store.save(user_id, user_messages)  # type: ignore
+
+def load_conversation_history(user_id):
+    return conversation_store.load(user_id)  # type: ignore
     
-async def get_crypto_infos(crypto_id, crypto_name):
+def reset_conversation_history(user_id):
+    return conversation_store.reset(user_id)  # type: ignore
+    
+# shared HTTP client of the external data fetchers, created by main()
+http_client = None
+# one semaphore per upstream host to limit the number of simultaneous connections to it
+host_semaphores = {}
+host_latencies = {}
+
+# latency of the requests made to one upstream host
+class HostLatency:
+    def __init__(self):
+        self.requests = 0
+        self.errors = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.recent = collections.deque(maxlen=200)
+
+    def record(self, latency, error=False):
+        self.requests += 1
+        self.errors += error
+        self.total += latency
+        self.max = max(self.max, latency)
+        self.recent.append(latency)
+
+    def summary(self):
+        recent = sorted(self.recent)
+        p95 = recent[int(len(recent) * 0.95) - 1] if recent else 0.0
+        average = self.total / self.requests if self.requests else 0.0
+        return f"{self.requests} requests, {self.errors} errors, avg {average * 1000:.0f} ms, p95 {p95 * 1000:.0f} ms, max {self.max * 1000:.0f} ms"
+
+def create_http_client():
+    http2 = HTTP_HTTP2
+    if http2:
+        try:
+            import h2  # noqa: F401
+        except ImportError:
+            log_message("HTTP/2 requested but the h2 package is not installed, using HTTP/1.1")
+            http2 = False
+    limits = httpx.Limits(max_connections=HTTP_MAX_CONNECTIONS, max_keepalive_connections=HTTP_MAX_CONNECTIONS, keepalive_expiry=HTTP_KEEPALIVE_EXPIRY)
+    timeout = httpx.Timeout(HTTP_TIMEOUT, connect=HTTP_CONNECT_TIMEOUT)
+    return httpx.AsyncClient(http2=http2, limits=limits, timeout=timeout)
+
+async def http_get(url, **kwargs):
+    host = httpx.URL(url).host
+    semaphore = host_semaphores.get(host)
+    if semaphore is None:
+        semaphore = host_semaphores[host] = asyncio.Semaphore(HTTP_MAX_CONNECTIONS_PER_HOST)
+    latency = host_latencies.get(host)
+    if latency is None:
+        latency = host_latencies[host] = HostLatency()
+
+    async with semaphore:
+        start = time.perf_counter()
+        try:
+            response = await http_client.get(url, **kwargs)  # type: ignore
+        except Exception:
+            latency.record(time.perf_counter() - start, error=True)
+            metrics.inc("gptplus_http_errors_total", host=host, status="exception")
+            raise
+    latency.record(time.perf_counter() - start, error=response.status_code >= 400)
+    metrics.observe("gptplus_http_request_seconds", time.perf_counter() - start, host=host)
+    if response.status_code >= 400:
+        metrics.inc("gptplus_http_errors_total", host=host, status=response.status_code)
+    return response
+
+def log_http_latencies():
+    for host, latency in host_latencies.items():
+        log_message(f"Latency of {host}: {latency.summary()}")
+
+# cache of the external data with a time to live, LRU eviction and optional persistence on disk
+class TTLCache:
+    def __init__(self, name, ttl, maxsize, filename=None, stale_ttl=0):
+        self.name = name
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.filename = filename
+        # seconds an expired value is still served while it is refreshed in the background (stale-while-revalidate)
+        self.stale_ttl = stale_ttl
+        # key -> (value, expiry as a unix timestamp so that it survives a restart)
+        self.entries = collections.OrderedDict()
+        # key -> future of the fetch in progress, shared by the concurrent misses
+        self.in_flight = {}
+        self.background = set()
+        # key -> last time it was asked by a user, the background refresher ignores the keys nobody asks for any more
+        self.requested_at = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.stale_hits = 0
+        self.max_staleness = 0.0
+        self.refreshes = 0
+        self.refresh_time = 0.0
+        if filename:
+            self.load()
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        if entry[1] <= time.time():
+            if time.time() - entry[1] > self.stale_ttl:
+                del self.entries[key]
+            return None
+        self.entries.move_to_end(key)
+        return entry[0]
+
+    def set(self, key, value, ttl=None):
+        self.entries[key] = (value, time.time() + (ttl if ttl is not None else self.ttl))
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+    def requested_within(self, key, seconds):
+        return time.monotonic() - self.requested_at.get(key, float("-inf")) <= seconds
+
+    def expires_in(self, key):
+        entry = self.entries.get(key)
+        return entry[1] - time.time() if entry else float("-inf")
+
+    async def get_or_fetch(self, key, fetch):
+        self.requested_at[key] = time.monotonic()
+        self.requested_at.move_to_end(key)
+        if len(self.requested_at) > self.maxsize:
+            self.requested_at.popitem(last=False)
+        value = self.get(key)
+        if value is not None:
+            self.hits += 1
+            return value
+
+        entry = self.entries.get(key)
+        if entry is not None:
+            # expired but still in the stale window: served now, refreshed in the background
+            self.stale_hits += 1
+            self.max_staleness = max(self.max_staleness, time.time() - entry[1])
+            if key not in self.in_flight:
+                task = asyncio.create_task(self.refresh(key, fetch))
+                self.background.add(task)
+                task.add_done_callback(self.background_done)
+            return entry[0]
+
+        if key in self.in_flight:
+            self.coalesced += 1
+        else:
+            self.misses += 1
+        return await self.refresh(key, fetch)
+
+    # fetches the value of the key again, concurrent calls for the same key share one fetch
+    async def refresh(self, key, fetch, ttl=None):
+        task = self.in_flight.get(key)
+        if task is None:
+            task = self.in_flight[key] = asyncio.create_task(self.run_fetch(key, fetch, ttl))
+            # mark the exception as retrieved when every caller was cancelled before the end of the fetch
+            task.add_done_callback(lambda task: task.cancelled() or task.exception())
+        # the fetch runs in its own task: a caller that is cancelled does not cancel it for the others
+        return await asyncio.shield(task)
+
+    async def run_fetch(self, key, fetch, ttl=None):
+        start = time.perf_counter()
+        try:
+            value = await fetch()
+            # failed fetches return None and are not cached
+            if value is not None:
+                self.set(key, value, ttl)
+            return value
+        finally:
+            del self.in_flight[key]
+            self.refreshes += 1
+            self.refresh_time += time.perf_counter() - start
+
+    def background_done(self, task):
+        self.background.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            log_message(f"Error while refreshing the {self.name} cache in the background: {task.exception()}", level="ERROR")
+
+    def load(self):
+        try:
+            with open(self.filename, "r", encoding="utf-8") as f:  # type: ignore
+                entries = json.load(f)
+        except FileNotFoundError:
+            return
+        except (OSError, json.JSONDecodeError) as e:
+            log_message(f"The cache file {self.filename} could not be read: {e}", level="WARNING")
+            return
+        now = time.time()
+        for key, (value, expiry) in entries.items():
+            if expiry > now:
+                self.entries[key] = (value, expiry)
+        log_message(f"{len(self.entries)} entries loaded in the {self.name} cache from {self.filename}")
+
+    def save(self):
+        if not self.filename:
+            return
+        try:
+            with open(self.filename, "w", encoding="utf-8") as f:
+                json.dump(dict(self.entries), f, ensure_ascii=False)
+        except OSError as e:
+            log_message(f"The cache file {self.filename} could not be written: {e}", level="WARNING")
+
+    def stats(self):
+        return {
+            "size": len(self.entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced,
+            "stale_hits": self.stale_hits,
+            "max_staleness": round(self.max_staleness, 1),
+            "refreshes": self.refreshes,
+            "refresh_time": round(self.refresh_time, 3),
+        }
+
+geocoding_cache = TTLCache("geocoding", CACHE_GEOCODING_TTL, CACHE_MAX_SIZE, CACHE_GEOCODING_FILE or None)
+# the workers of the supervisor mode do not run the background refresh
+cache_stale_ttl = CACHE_STALE_TTL if REFRESH_ENABLED and SHARD_INDEX is None else 0
+weather_cache = TTLCache("weather", CACHE_WEATHER_TTL, CACHE_MAX_SIZE, stale_ttl=cache_stale_ttl)
+news_cache = TTLCache("news", CACHE_NEWS_TTL, CACHE_MAX_SIZE, stale_ttl=cache_stale_ttl)
+crypto_cache = TTLCache("crypto", CACHE_CRYPTO_TTL, CACHE_MAX_SIZE, stale_ttl=cache_stale_ttl)
+caches = [geocoding_cache, weather_cache, news_cache, crypto_cache]
+
+# opt-in cache of the answers to the data questions, with the time to live of their data sources
+response_cache = TTLCache("responses", CACHE_WEATHER_TTL, RESPONSE_CACHE_MAX_SIZE)
+response_cache_saved_tokens = 0
+RESPONSE_CACHE_SOURCE_TTLS = {"crypto": CACHE_CRYPTO_TTL, "news": CACHE_NEWS_TTL, "weather": CACHE_WEATHER_TTL}
+
+def response_cache_hit_rate():
+    lookups = response_cache.hits + response_cache.misses
+    return round(response_cache.hits / lookups, 3) if lookups else 0.0
+
+def close_caches():
+    for cache in caches:
+        log_message(f"Cache {cache.name}: {cache.stats()}")
+        cache.save()
+    if RESPONSE_CACHE_ENABLED:
+        log_message(f"Response cache: {response_cache.stats()}, hit rate {response_cache_hit_rate()}, {response_cache_saved_tokens} tokens saved")
+
+# coins followed by the bot, from the COINS setting of the [CRYPTO] section: "coinpaprika id: alias, alias; ..."
+def parse_crypto_registry(coins):
+    registry = []
+    for entry in coins.split(";"):
+        if ":" not in entry:
+            continue
+        crypto_id, aliases = entry.split(":", 1)
+        aliases = [alias.strip().lower() for alias in aliases.split(",") if alias.strip()]
+        if aliases:
+            registry.append({"id": crypto_id.strip(), "name": aliases[0], "aliases": aliases})
+    return registry
+
+CRYPTO_REGISTRY = parse_crypto_registry(CRYPTO_COINS)
+
+# one request for the tickers of all the followed coins, shared by every question until the crypto cache expires
+async def get_crypto_tickers():
+    return await crypto_cache.get_or_fetch("tickers", fetch_crypto_tickers)
+
+# the response has the tickers of every listed coin (several MB), it is parsed in a thread to keep the event loop free
+def parse_crypto_tickers(content):
+    tracked = {coin["id"] for coin in CRYPTO_REGISTRY}
+    return {ticker["id"]: ticker for ticker in json.loads(content) if ticker["id"] in tracked}
+
+async def fetch_crypto_tickers():
     try:
-        async with httpx.AsyncClient() as client:
-            response = await client.get(f"https://api.coinpaprika.com/v1/tickers/{crypto_id}")
-            response.raise_for_status()
-            data = response.json()
-            crypto_infos = data
-            log_message(f"Successful recovery of information on the crypto {crypto_name}: {data}")
-            return crypto_infos
-    except (httpx.HTTPError, KeyError):
-        log_message(f"Error while retrieving crypto info")
+        response = await http_get(f"{COINPAPRIKA_BASE_URL}/v1/tickers", params={"quotes": "USD"})
+        response.raise_for_status()
+        tickers = await asyncio.to_thread(parse_crypto_tickers, response.content)
+        log_message(f"Successful recovery of the tickers of {len(tickers)} cryptos")
+        return tickers
+    except (httpx.HTTPError, KeyError, TypeError, ValueError) as e:
+        log_message(f"Error while retrieving crypto info: {e}", level="ERROR")
         return None
 
+async def get_crypto_infos(crypto_id, crypto_name):
+    tickers = await get_crypto_tickers()
+    if tickers is None:
+        return None
+    crypto_infos = tickers.get(crypto_id)
+    if crypto_infos is None:
+        log_message(f"No ticker for the crypto {crypto_name} ({crypto_id})", level="WARNING")
+    return crypto_infos
+
+# fields of the ticker sent to the model depending on the question, the price and the daily change are always sent
+CRYPTO_FIELDS = {
+    "percent_change_1h": ["heure", "hour", "1h"],
+    "percent_change_7d": ["semaine", "week", "7d", "7j"],
+    "percent_change_30d": ["mois", "month", "30d", "30j"],
+    "percent_change_1y": ["année", "year", "1y"],
+    "volume_24h": ["volume", "volumes"],
+    "market_cap": ["capitalisation", "capitalization", "cap", "marketcap"],
+    "ath_price": ["ath", "record", "highest"],
+    "rank": ["rang", "rank", "classement", "ranking"],
+    "circulating_supply": ["supply", "offre", "circulation"],
+}
+CRYPTO_FIELDS_TABLE = {keyword: field for field, keywords in CRYPTO_FIELDS.items() for keyword in keywords}
+CRYPTO_FIELDS_RE = re.compile(r"(?<!\w)(" + "|".join(re.escape(keyword) for keyword in CRYPTO_FIELDS_TABLE) + r")(?!\w)")
+
+def project_crypto_ticker(ticker, prompt):
+    quote = ticker.get("quotes", {}).get("USD", {})
+    fields = {CRYPTO_FIELDS_TABLE[keyword] for keyword in CRYPTO_FIELDS_RE.findall(prompt.lower())}
+    projected = {
+        "name": ticker.get("name"),
+        "symbol": ticker.get("symbol"),
+        "price_usd": quote.get("price"),
+        "percent_change_24h": quote.get("percent_change_24h"),
+        "last_updated": ticker.get("last_updated"),
+    }
+    for field in fields:
+        if field == "rank":
+            projected["rank"] = ticker.get("rank")
+        elif field == "circulating_supply":
+            projected["circulating_supply"] = ticker.get("circulating_supply")
+            projected["max_supply"] = ticker.get("max_supply")
+        elif field == "ath_price":
+            projected["ath_price_usd"] = quote.get("ath_price")
+            projected["ath_date"] = quote.get("ath_date")
+            projected["percent_from_price_ath"] = quote.get("percent_from_price_ath")
+        else:
+            projected[field] = quote.get(field)
+    return projected
+
 async def get_news_headlines(news_category: str):
+    return await news_cache.get_or_fetch(news_category, lambda: fetch_news_headlines(news_category))
+
+async def fetch_news_headlines(news_category: str):
     if not NEWSAPI_KEY:
-        log_message(f"A key in the ini file for the news api was NOT detected")
+        log_message(f"A key in the ini file for the news api was NOT detected", level="WARNING")
     else:
         log_message(f"A key in the ini file for the news api has been detected")
     if news_category == "monde":
         # Modifier l'URL pour récupérer les actualités mondiales
-        url = f"https://newsapi.org/v2/top-headlines?country=us&apiKey={NEWSAPI_KEY}"
+        url = f"{NEWSAPI_BASE_URL}/v2/top-headlines?country=us&apiKey={NEWSAPI_KEY}"
     elif news_category == "france":
-        url = f"https://newsapi.org/v2/top-headlines?country=fr&apiKey={NEWSAPI_KEY}"
+        url = f"{NEWSAPI_BASE_URL}/v2/top-headlines?country=fr&apiKey={NEWSAPI_KEY}"
     elif news_category == "suisse":
-        url = f"https://newsapi.org/v2/top-headlines?country=ch&apiKey={NEWSAPI_KEY}"
+        url = f"{NEWSAPI_BASE_URL}/v2/top-headlines?country=ch&apiKey={NEWSAPI_KEY}"
     elif news_category == "usa":
-        url = f"https://newsapi.org/v2/top-headlines?country=us&apiKey={NEWSAPI_KEY}"
+        url = f"{NEWSAPI_BASE_URL}/v2/top-headlines?country=us&apiKey={NEWSAPI_KEY}"
     else:
-        url = f"https://newsapi.org/v2/top-headlines?language=fr&apiKey={NEWSAPI_KEY}"
+        url = f"{NEWSAPI_BASE_URL}/v2/top-headlines?language=fr&apiKey={NEWSAPI_KEY}"
 
     try:
-        async with aiohttp.ClientSession() as session:
-            async with session.get(url) as response:
-                data = await response.json()
+        response = await http_get(url)
+        data = response.json()
                 
         headlines = []
         for article in data["articles"][:10]:
@@ -146,18 +988,20 @@ async def get_news_headlines(news_category: str):
         return headlines
     
     except Exception as e:
-        log_message(f"Error when retrieving news : {e}")        
+        log_message(f"Error when retrieving news : {e}", level="ERROR")        
         return None
 
 async def get_city_coordinates(city_name: str, language: str) -> Optional[Tuple[float, float]]:
-    api_url = f"https://geocoding-api.open-meteo.com/v1/search?name={city_name}&count=1&language={language}&format=json"
+    return await geocoding_cache.get_or_fetch(f"{language}:{city_name.lower()}", lambda: fetch_city_coordinates(city_name, language))
+
+async def fetch_city_coordinates(city_name: str, language: str) -> Optional[Tuple[float, float]]:
+    api_url = f"{GEOCODING_BASE_URL}/v1/search?name={city_name}&count=1&language={language}&format=json"
     try:
-        async with ClientSession() as session:
-            async with session.get(api_url) as response:
-                if response.status != 200:
-                    log_message(f"API error, status code: {response.status}") 
-                    raise Exception(f"API error, status code: {response.status}")
-                data = await response.json()
+        response = await http_get(api_url)
+        if response.status_code != 200:
+            log_message(f"API error, status code: {response.status_code}", level="ERROR") 
+            raise Exception(f"API error, status code: {response.status_code}")
+        data = response.json()
 
         if data and data['results']:
             latitude = data['results'][0]['latitude']
@@ -165,176 +1009,599 @@ async def get_city_coordinates(city_name: str, language: str) -> Optional[Tuple[
             return latitude, longitude
 
     except Exception as e:
-        log_message(f"Error retrieving city coordinates: {e}")        
+        log_message(f"Error retrieving city coordinates: {e}", level="ERROR")        
         return None
 
+def weather_cache_key(latitude, longitude):
+    return f"{latitude:.3f},{longitude:.3f}"
+
 async def get_weather_data(latitude: float, longitude: float) -> Optional[dict]:
-    api_url = f"https://api.open-meteo.com/v1/forecast?latitude={latitude}&longitude={longitude}&hourly=temperature_2m,relativehumidity_2m,precipitation,surface_pressure,cloudcover,windspeed_10m&models=best_match&daily=sunrise,sunset&forecast_days=3&timezone=Europe%2FBerlin"
+    return await weather_cache.get_or_fetch(weather_cache_key(latitude, longitude), lambda: fetch_weather_data(latitude, longitude))
+
+async def fetch_weather_data(latitude: float, longitude: float) -> Optional[dict]:
+    api_url = f"{WEATHER_BASE_URL}/v1/forecast?latitude={latitude}&longitude={longitude}&hourly=temperature_2m,relativehumidity_2m,precipitation,surface_pressure,cloudcover,windspeed_10m&models=best_match&current_weather=true&daily=sunrise,sunset,uv_index_max&forecast_days=3&timezone=auto"
        
     try:
-        async with ClientSession() as session:
-            async with session.get(api_url) as response:
-                if response.status != 200:
-                    log_message(f"API error, status code: {response.status}") 
-                    raise Exception(f"API error, status code: {response.status}")
-                data = await response.json()
-                weather_data = data
-                return weather_data
+        response = await http_get(api_url)
+        if response.status_code != 200:
+            log_message(f"API error, status code: {response.status_code}", level="ERROR") 
+            raise Exception(f"API error, status code: {response.status_code}")
+        data = response.json()
+        weather_data = data
+        return weather_data
 
     except Exception as e:
-        log_message(f"Error retrieving weather data: {e}")        
+        log_message(f"Error retrieving weather data: {e}", level="ERROR")        
         return None
 
-async def get_gpt4_response(prompt, user_messages, bot, chat_id, authorized_chat_id=None, external_data=None):
-    # log the unauthorized chat id that tries to call your bot
-    if chat_id != authorized_chat_id:
-        await bot.send_message(chat_id, f"Unauthorized access from the user (your chat ID: {chat_id}). You can use my telegram bot with my code : https://github.com/Macmachi/gptplus/")
-        log_message(f"Unauthorized access of the user with the chat_id {chat_id}")
-        return
+# keywords of the intents, matched as whole words: keyword -> list of (intent, value)
+NEWS_KEYWORDS = {
+    "fr": ["actualités", "actualité", "l'actualité", "nouvelles", "infos", "informations"],
+    "en": ["news", "headlines"],
+}
+# in order of priority when several categories are in the prompt, "monde" is the default
+NEWS_CATEGORIES = {
+    "monde": ["monde", "world"],
+    "france": ["france", "française", "français", "french"],
+    "suisse": ["suisse", "switzerland", "swiss"],
+    "usa": ["usa"],
+}
+NEWS_CATEGORY_PRIORITY = list(NEWS_CATEGORIES)
+WEATHER_KEYWORDS = {
+    "fr": ["météo", "temps", "température", "prévision", "prévisions", "soleil", "uv", "vent", "pluie", "humidité"],
+    "en": ["weather", "temperature", "forecast", "sun", "wind", "rain", "humidity"],
+}
+# the preposition between the weather keyword and the city gives the language of the geocoding
+CITY_PREPOSITIONS = {"à": "fr", "a": "fr", "pour": "fr", "in": "en", "of": "en", "for": "en", "at": "en"}
+# words read after a preposition that are not a city ("weather for the weekend", "wind at night")
+CITY_STOPWORDS = {
+    "the", "a", "an", "my", "this", "next", "tomorrow", "today", "tonight", "night", "morning", "afternoon", "evening", "weekend", "week",
+    "le", "la", "les", "l", "ce", "cette", "demain", "aujourd", "soir", "nuit", "matin", "midi", "semaine",
+}
 
-    crypto_data = [
-        {"name": "bitcoin", "id": "btc-bitcoin"},
-        {"name": "ethereum", "id": "eth-ethereum"},
-        {"name": "avax", "id": "avax-avalanche"},
-        {"name": "monero", "id": "xmr-monero"},
-    ]
-
-    for crypto in crypto_data:
-        if crypto["name"] in prompt.lower():
-            crypto_infos = await get_crypto_infos(crypto["id"], crypto["name"])
-            log_message(f"Successful retrieval of crypto prices from get_gpt4_response")
-
-            if crypto["name"] is not None:
-                external_data = f"The crypto information: {crypto_infos} as of the current date and time, {datetime.datetime.now()}, that you need to interpret based on the question in this prompt: {prompt}"
-
-    # news in French
-    if "actualités" in prompt.lower() or "l'actualité" in prompt.lower() or "nouvelles" in prompt.lower() or "infos" in prompt.lower() or "informations" in prompt.lower():
-        if "monde" in prompt.lower():
-            news_category = "monde"
-        elif "france" in prompt.lower():
-            news_category = "france"
-        elif "française" in prompt.lower():
-            news_category = "france"              
-        elif "suisse" in prompt.lower():
-            news_category = "suisse"                
-        elif "usa" in prompt.lower():
-            news_category = "usa"             
-        else:
-            news_category = "monde"
-        
-        news_headlines = await get_news_headlines(news_category)
+def build_intent_table():
+    table = collections.defaultdict(list)
+    for crypto in CRYPTO_REGISTRY:
+        for alias in crypto["aliases"]:
+            table[alias].append(("crypto", crypto))
+    for language, keywords in NEWS_KEYWORDS.items():
+        for keyword in keywords:
+            table[keyword].append(("news", language))
+    for category, keywords in NEWS_CATEGORIES.items():
+        for keyword in keywords:
+            table[keyword].append(("news_category", category))
+    for language, keywords in WEATHER_KEYWORDS.items():
+        for keyword in keywords:
+            table[keyword].append(("weather", language))
+    return dict(table)
+
+INTENT_TABLE = build_intent_table()
+# one alternation of every keyword, longest first, on word boundaries
+INTENT_RE = re.compile(r"(?<!\w)(" + "|".join(re.escape(keyword) for keyword in sorted(INTENT_TABLE, key=len, reverse=True)) + r")(?!\w)")
+CITY_RE = re.compile(r"\s+(" + "|".join(CITY_PREPOSITIONS) + r")\s+(\w+)")
+SENTENCE_END_RE = re.compile(r"[.?!;\n]")
+
+# first "preposition city" after the weather keyword in the same sentence, the stop words are skipped
+def find_city(text, start):
+    sentence_end = SENTENCE_END_RE.search(text, start)
+    for city_match in CITY_RE.finditer(text, start, sentence_end.start() if sentence_end else len(text)):
+        if city_match.group(2) not in CITY_STOPWORDS:
+            return city_match
+    return None
+
+# list of the lookups needed by the prompt, without duplicates: ("crypto", id, name), ("news", category, language), ("weather", city, language)
+def plan_external_lookups(prompt):
+    text = prompt.lower()
+    lookups = []
+    news_language = None
+    news_categories = set()
+
+    # single pass over the prompt
+    for match in INTENT_RE.finditer(text):
+        for intent, value in INTENT_TABLE[match.group(1)]:
+            if intent == "crypto":
+                lookups.append(("crypto", value["id"], value["name"]))
+            elif intent == "news":
+                news_language = news_language or value
+            elif intent == "news_category":
+                news_categories.add(value)
+            elif intent == "weather":
+                city_match = find_city(text, match.end())
+                if city_match:
+                    lookups.append(("weather", city_match.group(2), CITY_PREPOSITIONS[city_match.group(1)]))
+
+    if news_language:
+        news_category = next((category for category in NEWS_CATEGORY_PRIORITY if category in news_categories), "monde")
+        lookups.append(("news", news_category, news_language))
+
+    # the same crypto, news category or city asked twice is fetched only once
+    planned = {}
+    for lookup in lookups:
+        planned.setdefault(lookup[:2], lookup)
+    return list(planned.values())
+
+async def lookup_crypto(crypto_id, crypto_name, prompt):
+    crypto_infos = await get_crypto_infos(crypto_id, crypto_name)
+    if crypto_infos:
+        log_message(f"Successful retrieval of crypto prices from get_gpt4_response")
+        crypto_infos = project_crypto_ticker(crypto_infos, prompt)
+        return f"The crypto information: {crypto_infos} as of the current date and time, {datetime.datetime.now()}, that you need to interpret based on the question in this prompt: {prompt}", crypto_infos
+
+async def lookup_news(news_category, language, prompt):
+    news_headlines = await get_news_headlines(news_category)
+    if news_headlines is None:
+        log_message(f"Error while retrieving news for the category {news_category}", level="ERROR")
+    elif language == "fr":
         log_message(f"Succès de la récupération des headlines depuis get_gpt4_response")
-        if news_headlines:
-            external_data = f"Voici les actualités aujourd'hui à {datetime.datetime.now()} à traduire en français (si elles ne sont pas en français) pour ({news_category}) : \n\n" + "".join(news_headlines)
-
-    # news in English 
-    if "news" in prompt.lower() or "new" in prompt.lower() or "headlines" in prompt.lower() :
-        if "world" in prompt.lower():
-            news_category = "monde"
-        elif "france" in prompt.lower():
-            news_category = "france"
-        elif "french" in prompt.lower():
-            news_category = "france"    
-        elif "switzerland" in prompt.lower():
-            news_category = "suisse"  
-        elif "swiss" in prompt.lower():
-            news_category = "suisse"       
-        elif "usa" in prompt.lower():
-            news_category = "usa"             
-        else:
-            news_category = "monde"
-
-        news_headlines = None
-        if news_category:
-            log_message(f"Successful recovery of the category {news_category}")
-            news_headlines = await get_news_headlines(news_category)
-            if news_headlines is None:
-                log_message(f"Error while retrieving news for the category {news_category}")
+        return f"Voici les actualités aujourd'hui à {datetime.datetime.now()} à traduire en français (si elles ne sont pas en français) pour ({news_category}) : \n\n" + "".join(news_headlines), news_headlines
+    else:
+        log_message(f"Successful retrieval of headlines from get_news_headlines")
+        return f"Here are the news today at {datetime.datetime.now()} to be translated into english (if they are not in english) for ({news_category}) : \n\n" + "".join(news_headlines), news_headlines
+
+# weather variables asked in the question: focus -> keywords, all of them when none is asked
+WEATHER_FOCUS = {
+    "rain": ["pluie", "pluies", "pleuvoir", "précipitation", "précipitations", "parapluie", "rain", "precipitation", "umbrella"],
+    "wind": ["vent", "vents", "wind"],
+    "humidity": ["humidité", "humidity"],
+    "sun": ["soleil", "uv", "nuages", "sun", "sunny", "clouds", "cloudy"],
+}
+WEATHER_FOCUS_TABLE = {keyword: focus for focus, keywords in WEATHER_FOCUS.items() for keyword in keywords}
+WEATHER_FOCUS_RE = re.compile(r"(?<!\w)(" + "|".join(re.escape(keyword) for keyword in WEATHER_FOCUS_TABLE) + r")(?!\w)")
+
+# index range of each day in the hourly columns, computed once and used to slice every column
+def hourly_day_ranges(times):
+    ranges = {}
+    for index, timestamp in enumerate(times):
+        day = timestamp[:10]
+        start = ranges[day][0] if day in ranges else index
+        ranges[day] = (start, index + 1)
+    return ranges
+
+def aggregate(values, function):
+    values = [value for value in values if value is not None]
+    return round(function(values), 1) if values else "-"
+
+# compact summary of the Open-Meteo forecast for the prompt instead of the full hourly JSON
+def summarize_weather(weather_data, prompt):
+    focus = {WEATHER_FOCUS_TABLE[keyword] for keyword in WEATHER_FOCUS_RE.findall(prompt.lower())} or set(WEATHER_FOCUS)
+    hourly = weather_data.get("hourly", {})
+    daily = weather_data.get("daily", {})
+    times = hourly.get("time", [])
+    # the times of the forecast are in the timezone of the city
+    local_now = datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None) + datetime.timedelta(seconds=weather_data.get("utc_offset_seconds", 0))
+    current_hour = f"{local_now:%Y-%m-%dT%H}:00"
+
+    lines = [f"Timezone {weather_data.get('timezone', 'GMT')}, local date and time {local_now:%Y-%m-%d %H:%M}"]
+    current = weather_data.get("current_weather")
+    if current:
+        lines.append(f"Now: {current.get('temperature')}°C, wind {current.get('windspeed')} km/h, WMO weather code {current.get('weathercode')}")
+
+    header = ["day", "temp min/max °C", "precipitation mm"]
+    if "wind" in focus:
+        header.append("wind max km/h")
+    if "humidity" in focus:
+        header.append("humidity min/max %")
+    if "sun" in focus:
+        header += ["clouds avg %", "sunrise", "sunset", "uv max"]
+    lines.append(" | ".join(header))
+
+    daily_index = {day: index for index, day in enumerate(daily.get("time", []))}
+    for day, (start, end) in hourly_day_ranges(times).items():
+        temperatures = hourly.get("temperature_2m", [])[start:end]
+        row = [day, f"{aggregate(temperatures, min)}/{aggregate(temperatures, max)}", str(aggregate(hourly.get("precipitation", [])[start:end], sum))]
+        if "wind" in focus:
+            row.append(str(aggregate(hourly.get("windspeed_10m", [])[start:end], max)))
+        if "humidity" in focus:
+            humidity = hourly.get("relativehumidity_2m", [])[start:end]
+            row.append(f"{aggregate(humidity, min)}/{aggregate(humidity, max)}")
+        if "sun" in focus:
+            index = daily_index.get(day)
+            sunrise = daily.get("sunrise", [])[index][11:] if index is not None and daily.get("sunrise") else "-"
+            sunset = daily.get("sunset", [])[index][11:] if index is not None and daily.get("sunset") else "-"
+            uv = daily.get("uv_index_max", [])[index] if index is not None and daily.get("uv_index_max") else "-"
+            row += [str(aggregate(hourly.get("cloudcover", [])[start:end], lambda values: sum(values) / len(values))), sunrise, sunset, str(uv)]
+        lines.append(" | ".join(row))
+
+    if "rain" in focus:
+        # periods with precipitation from the current hour
+        windows = []
+        last_index = None
+        for index, (timestamp, precipitation) in enumerate(zip(times, hourly.get("precipitation", []))):
+            if timestamp < current_hour or not precipitation:
+                continue
+            # consecutive rainy hours are joined in one period
+            if windows and last_index == index - 1:
+                windows[-1][1] = timestamp
+                windows[-1][2] += precipitation
             else:
-                log_message(f"Successful retrieval of headlines from get_news_headlines")
-        if news_headlines:
-            external_data = f"Here are the news today at {datetime.datetime.now()} to be translated into english (if they are not in english) for ({news_category}) : \n\n" + "".join(news_headlines)
-
-    # weather in French
-    keywords = ["temps", "météo", "température", "soleil", "uv", "vent", "pluie", "humidité", "prévision"]
-    if any(keyword in prompt.lower() for keyword in keywords):
-        city_match = re.search(r"\b(?:météo|temps|température|prévision|soleil|uv|vent|pluie|humidité)\s+(?:à|pour|a)?\s+(\w+)", prompt.lower())
-        if city_match:
-            city_name = city_match.group(1)
-            language = 'fr'
-            coordinates = await get_city_coordinates(city_name, language)
-            if coordinates:
-                weather_data = await get_weather_data(*coordinates)
-                log_message(f"Successful retrieval of weather data from get_gpt4_response")
-                if weather_data:
-                    external_data = f"Voici les données météo pour la ville de {city_name.capitalize()}, les données que tu dois interpréter selon la question de l'utilisateur : {weather_data} sachant que la date et l'heure actuel est {datetime.datetime.now()}."
-
-    # weather in English 
-    keywords = ["weather","temperature","forecast","sun","uv","wind","rain","humidity"]
-    if any(keyword in prompt.lower() for keyword in keywords):
-        city_match = re.search(r"\b(?:weather|temperature|forecast|sun|uv|wind|rain|humidity)\s+(?:à|pour|in|of)?\s+(\w+)", prompt.lower())
-        if city_match:
-            city_name = city_match.group(1)
-            language = 'en'
-            coordinates = await get_city_coordinates(city_name, language)
-            if coordinates:
-                weather_data = await get_weather_data(*coordinates)
-                log_message(f"Successful retrieval of weather data from get_gpt4_response")
-                if weather_data:
-                    external_data = f"Here are the weather data for the city of {city_name.capitalize()}, the data you need to interpret according to the user's question: {weather_data}, knowing that the current date and time is {datetime.datetime.now()}."
-
-    previous_messages = "\n".join([f"{msg['role']}: {msg['content']}" for msg in user_messages])
+                windows.append([timestamp, timestamp, precipitation])
+            last_index = index
+        if windows:
+            lines.append("Precipitation periods: " + ", ".join(f"{start[:10]} {start[11:]}-{end[11:13]}:59 ({amount:.1f} mm)" for start, end, amount in windows))
+        else:
+            lines.append("Precipitation periods: none")
+
+    return "\n".join(lines)
+
+async def lookup_weather(city_name, language, prompt):
+    weather_demand[(city_name, language)] += 1
+    coordinates = await get_city_coordinates(city_name, language)
+    if coordinates:
+        weather_data = await get_weather_data(*coordinates)
+        if weather_data:
+            log_message(f"Successful retrieval of weather data from get_gpt4_response")
+            weather_summary = summarize_weather(weather_data, prompt)
+            if language == "fr":
+                return f"Voici les données météo pour la ville de {city_name.capitalize()}, les données que tu dois interpréter selon la question de l'utilisateur :\n{weather_summary}", weather_data
+            return f"Here are the weather data for the city of {city_name.capitalize()}, the data you need to interpret according to the user's question:\n{weather_summary}", weather_data
+
+# fetcher of each kind of lookup, returning the text for the model and the raw data it comes from
+EXTERNAL_LOOKUPS = {
+    "crypto": lookup_crypto,
+    "news": lookup_news,
+    "weather": lookup_weather,
+}
+
+async def run_external_lookup(lookup, prompt):
+    kind, key, detail = lookup
+    try:
+        with metrics.span(f"lookup_{kind}", key=key):
+            return await EXTERNAL_LOOKUPS[kind](key, detail, prompt)
+    except Exception as e:
+        log_message(f"Error while retrieving the external data {lookup}: {e}", level="ERROR")
+        return None
+
+# token counting with tiktoken, the encoding is loaded once by main()
+token_encoding = None
+
+def load_token_encoding():
+    global token_encoding
+    if token_encoding is None:
+        try:
+            token_encoding = tiktoken.encoding_for_model(OPENAI_MODEL) if tiktoken else False
+        except Exception as e:
+            log_message(f"The tiktoken encoding of {OPENAI_MODEL} could not be loaded, the tokens are estimated: {e}", level="WARNING")
+            token_encoding = False
+    return token_encoding
 
+def count_tokens(text):
+    encoding = load_token_encoding()
+    if not encoding:
+        # about 4 characters per token
+        return len(text) // 4 + 1
+    return len(encoding.encode(text))
+
+def truncate_to_tokens(text, max_tokens):
+    encoding = load_token_encoding()
+    if not encoding:
+        return text[:max(max_tokens, 0) * 4]
+    tokens = encoding.encode(text)
+    return text if len(tokens) <= max_tokens else encoding.decode(tokens[:max(max_tokens, 0)])
+
+# every message costs about 4 tokens of formatting and the answer is primed with 3 tokens
+def count_message_tokens(messages):
+    return 3 + sum(4 + count_tokens(message["content"]) for message in messages)
+
+# running totals of the tokens and of the estimated cost in dollars since the start
+usage_totals = {"prompt_tokens": 0, "completion_tokens": 0, "images": 0, "cost": 0.0}
+
+def record_usage(chat_id, prompt_tokens=0, completion_tokens=0, images=0):
+    cost = prompt_tokens / 1000 * OPENAI_PROMPT_PRICE + completion_tokens / 1000 * OPENAI_COMPLETION_PRICE + images * OPENAI_IMAGE_PRICE
+    usage_totals["prompt_tokens"] += prompt_tokens
+    usage_totals["completion_tokens"] += completion_tokens
+    usage_totals["images"] += images
+    usage_totals["cost"] += cost
+    metrics.inc("gptplus_tokens_total", prompt_tokens, kind="prompt")
+    metrics.inc("gptplus_tokens_total", completion_tokens, kind="completion")
+    metrics.inc("gptplus_images_total", images)
+    metrics.inc("gptplus_cost_dollars_total", cost)
+    log_message(f"Usage for the chat {chat_id}: {prompt_tokens} prompt tokens, {completion_tokens} completion tokens, {images} images, ${cost:.4f} (total since start ${usage_totals['cost']:.4f})")
+    return cost
+
+# messages sent to the model: instructions, the most recent history that fits in the token budget, the external data and the question
+def build_chat_messages(prompt, user_messages, external_data=None, budget=None):
+    budget = budget or OPENAI_CONTEXT_BUDGET
+    instructions = {"role": "system", "content": "Adapte toi à la langue utilisée pour la question de l'utilisateur."}
+    question = {"role": "user", "content": prompt}
+    fixed = [instructions, question]
     if external_data:
-        prompt_with_history = f"Voici les messages précédents :\n{previous_messages}\nMa question (adapte toi à la langue utilisée pour ma question) : {prompt}\nLa réponse actuelle de l'API que tu dois reformuler pour me répondre : {external_data}"
-    else:
-        prompt_with_history = f"Voici les messages précédents :\n{previous_messages}\nMa question (adapte toi à la langue utilisée pour ma question) : {prompt}"
+        data = {"role": "system", "content": f"La réponse actuelle de l'API que tu dois reformuler pour répondre à la question : {external_data}"}
+        # the external data is cut if it does not fit in the budget on its own
+        available = budget - count_message_tokens(fixed) - 4
+        if count_tokens(data["content"]) > available:
+            data["content"] = truncate_to_tokens(data["content"], available)
+            log_message(f"External data truncated to {available} tokens to fit in the context budget", level="WARNING")
+        fixed.insert(1, data)
+
+    # the conversation history stores the answers with the role gpt4
+    history = [{"role": "user" if message["role"] == "user" else "assistant", "content": message["content"] or ""} for message in user_messages]
+    history_tokens = [4 + count_tokens(message["content"]) for message in history]
+    used = count_message_tokens(fixed)
+    # the oldest messages are dropped first
+    while history and used + sum(history_tokens) > budget:
+        history.pop(0)
+        history_tokens.pop(0)
+
+    messages = [instructions] + history + fixed[1:]
+    return messages, used + sum(history_tokens)
+
+# number of questions per city, the most asked cities are kept warm by the background refresher
+weather_demand = collections.Counter()
+
+# keeps the hot keys of the caches fresh in the background so that the users are served from memory
+class BackgroundRefresher:
+    def __init__(self, jitter, min_request_interval, idle_timeout):
+        self.jitter = jitter
+        self.idle_timeout = idle_timeout
+        self.min_request_interval = min_request_interval
+        self.sources = []
+        self.tasks = []
+        self.stats = {}
+
+    # hot_keys returns the (key, fetch) couples to keep fresh in the cache
+    def add(self, name, cache, interval, hot_keys):
+        self.sources.append((name, cache, interval, hot_keys))
+        self.stats[name] = {"rounds": 0, "refreshes": 0, "errors": 0, "refresh_time": 0.0}
+
+    def start(self):
+        self.tasks = [asyncio.create_task(self.run(*source)) for source in self.sources]
+
+    async def stop(self):
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        for name, stats in self.stats.items():
+            log_message(f"Background refresh of {name}: {stats}")
+
+    async def run(self, name, cache, interval, hot_keys):
+        stats = self.stats[name]
+        while True:
+            try:
+                for key, fetch in await hot_keys():
+                    # only the keys asked recently and expiring before the next round are fetched again
+                    if not cache.requested_within(key, self.idle_timeout) or cache.expires_in(key) > interval * (1 + self.jitter):
+                        continue
+                    start = time.perf_counter()
+                    # the refreshed value lives until the next round, the users never wait for a source refreshed less often than its TTL
+                    value = await cache.refresh(key, fetch, max(cache.ttl, interval * (1 + self.jitter)))
+                    stats["refreshes"] += 1
+                    stats["errors"] += value is None
+                    stats["refresh_time"] += time.perf_counter() - start
+                    # rate limit of each source, the upstream APIs are not called in bursts
+                    await asyncio.sleep(self.min_request_interval)
+            except Exception as e:
+                stats["errors"] += 1
+                log_message(f"Error while refreshing {name} in the background: {e}", level="ERROR")
+            stats["rounds"] += 1
+            # the jitter spreads the refreshes of the sources over time
+            await asyncio.sleep(interval * random.uniform(1 - self.jitter, 1 + self.jitter))
+
+async def hot_news_keys():
+    return [(category, lambda category=category: fetch_news_headlines(category)) for category in REFRESH_NEWS_CATEGORIES]
+
+async def hot_crypto_keys():
+    return [("tickers", fetch_crypto_tickers)]
 
-    log_message(f"Updated prompt with external data: {prompt_with_history}")
+async def hot_weather_keys():
+    keys = []
+    for (city_name, language), _ in weather_demand.most_common(REFRESH_HOT_CITIES):
+        coordinates = await get_city_coordinates(city_name, language)
+        if coordinates:
+            latitude, longitude = coordinates
+            keys.append((weather_cache_key(latitude, longitude), lambda latitude=latitude, longitude=longitude: fetch_weather_data(latitude, longitude)))
+    return keys
+
+def create_background_refresher():
+    refresher = BackgroundRefresher(REFRESH_JITTER, REFRESH_MIN_REQUEST_INTERVAL, REFRESH_IDLE_TIMEOUT)
+    if REFRESH_NEWS_INTERVAL > 0:
+        refresher.add("news", news_cache, REFRESH_NEWS_INTERVAL, hot_news_keys)
+    if REFRESH_CRYPTO_INTERVAL > 0:
+        refresher.add("crypto", crypto_cache, REFRESH_CRYPTO_INTERVAL, hot_crypto_keys)
+    if REFRESH_WEATHER_INTERVAL > 0:
+        refresher.add("weather", weather_cache, REFRESH_WEATHER_INTERVAL, hot_weather_keys)
+    return refresher
+
+# lookups still running after the deadline, asyncio only keeps weak references to the tasks
+late_lookups = set()
+
+# runs all the lookups of the prompt concurrently and merges their results, with a digest of the raw data they come from
+async def fetch_external_data(prompt, lookups=None):
+    if lookups is None:
+        lookups = plan_external_lookups(prompt)
+    if not lookups:
+        return None, None
+
+    tasks = [asyncio.ensure_future(run_external_lookup(lookup, prompt)) for lookup in lookups]
+    done, pending = await asyncio.wait(tasks, timeout=EXTERNAL_DATA_DEADLINE)
+    # late lookups are not cancelled: they keep running to fill the cache for the next questions
+    for lookup, task in zip(lookups, tasks):
+        if task in pending:
+            late_lookups.add(task)
+            task.add_done_callback(late_lookups.discard)
+            log_message(f"The external data {lookup} was not received within {EXTERNAL_DATA_DEADLINE}s, answering without it")
+            metrics.inc("gptplus_lookup_timeouts_total", kind=lookup[0])
+
+    results = [task.result() for task in tasks if task in done and task.result()]
+    if not results:
+        return None, None
+    digest = hashlib.sha256(json.dumps([data for _, data in results], sort_keys=True, default=str).encode()).hexdigest()
+    return "\n\n".join(text for text, _ in results), digest
+
+# minimum time between two messages or edits sent to the same chat, shared by all the answers
+class ChatRateLimiter:
+    def __init__(self, interval):
+        self.interval = interval
+        self.next_allowed = {}
+
+    def ready(self, chat_id):
+        return time.monotonic() >= self.next_allowed.get(chat_id, 0)
+
+    async def wait(self, chat_id):
+        delay = self.next_allowed.get(chat_id, 0) - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    def sent(self, chat_id):
+        self.block(chat_id, self.interval)
+
+    def block(self, chat_id, seconds):
+        self.next_allowed[chat_id] = max(self.next_allowed.get(chat_id, 0), time.monotonic() + seconds)
+
+chat_rate_limiter = ChatRateLimiter(TELEGRAM_CHAT_INTERVAL)
+
+# shows a streamed answer in one Telegram message edited in place, a new message is started only at the size limit of Telegram
+class TelegramStreamRenderer:
+    def __init__(self, bot, chat_id, flush_interval=None):
+        self.bot = bot
+        self.chat_id = chat_id
+        self.flush_interval = flush_interval if flush_interval is not None else TELEGRAM_FLUSH_INTERVAL
+        # text of the current Telegram message, and the part of it already shown
+        self.text = ""
+        self.sent_text = ""
+        self.message_id = None
+        self.last_flush = time.monotonic()
+        self.api_calls = 0
+
+    async def feed(self, content):
+        self.text += content
+        while len(self.text) > TELEGRAM_MESSAGE_LIMIT:
+            # cut at the last line break or space before the limit when there is one
+            cut = max(self.text.rfind("\n", 0, TELEGRAM_MESSAGE_LIMIT), self.text.rfind(" ", 0, TELEGRAM_MESSAGE_LIMIT))
+            if cut <= 0:
+                cut = TELEGRAM_MESSAGE_LIMIT
+            head, self.text = self.text[:cut], self.text[cut:].lstrip()
+            await self.flush(head, final=True)
+            self.message_id = None
+            self.sent_text = ""
+        # the first words are shown as soon as they arrive, then the message is edited on a schedule
+        due = self.message_id is None or time.monotonic() - self.last_flush >= self.flush_interval
+        if due and chat_rate_limiter.ready(self.chat_id):
+            await self.flush(self.text)
+
+    async def finish(self):
+        await self.flush(self.text, final=True)
+
+    async def flush(self, text, final=False):
+        # an intermediate flush is skipped when Telegram asked to slow down, the final one waits
+        while text.strip() and text != self.sent_text:
+            if final:
+                await chat_rate_limiter.wait(self.chat_id)
+            elif not chat_rate_limiter.ready(self.chat_id):
+                return
+            try:
+                self.api_calls += 1
+                with metrics.span("telegram_send"):
+                    if self.message_id is None:
+                        sent_message = await self.bot.send_message(chat_id=self.chat_id, text=text, disable_web_page_preview=True)
+                        self.message_id = sent_message.message_id
+                    else:
+                        await self.bot.edit_message_text(text, chat_id=self.chat_id, message_id=self.message_id, disable_web_page_preview=True)
+                self.sent_text = text
+            except MessageNotModified:
+                self.sent_text = text
+            except RetryAfter as e:
+                log_message(f"Telegram asked to wait {e.timeout}s before updating the chat {self.chat_id}")
+                metrics.inc("gptplus_retry_after_total", source="stream")
+                chat_rate_limiter.block(self.chat_id, e.timeout)
+                continue
+            finally:
+                chat_rate_limiter.sent(self.chat_id)
+                self.last_flush = time.monotonic()
+
+async def get_gpt4_response(prompt, user_messages, bot, chat_id, external_data=None):
+    global response_cache_saved_tokens
+    # log the unauthorized chat id that tries to call your bot
+    if not is_authorized_chat(chat_id):
+        await bot.send_message(chat_id, f"Unauthorized access from the user (your chat ID: {chat_id}). You can use my telegram bot with my code : https://github.com/Macmachi/gptplus/")
+        log_message(f"Unauthorized access of the user with the chat_id {chat_id}", level="WARNING")
+        metrics.inc("gptplus_unauthorized_total")
+        return
+
+    with metrics.span("intent_detection"):
+        lookups = plan_external_lookups(prompt)
+    fetched_data, data_digest = await fetch_external_data(prompt, lookups)
+    if fetched_data:
+        external_data = fetched_data
+
+    # answers to the same data question are reused while the data they come from is unchanged
+    cache_key = None
+    if RESPONSE_CACHE_ENABLED and data_digest:
+        normalized_prompt = " ".join(re.findall(r"\w+", prompt.lower()))
+        cache_key = hashlib.sha256(f"{normalized_prompt}|{sorted(lookups)}|{data_digest}".encode()).hexdigest()
+        cached = response_cache.get(cache_key)
+        if cached is not None:
+            message, saved_tokens = cached
+            response_cache.hits += 1
+            response_cache_saved_tokens += saved_tokens
+            log_message(f"Answer served from the response cache for the chat {chat_id}", saved_tokens=saved_tokens, hit_rate=response_cache_hit_rate())
+            renderer = TelegramStreamRenderer(bot, chat_id)
+            await renderer.feed(message)
+            await renderer.finish()
+            return message
+        response_cache.misses += 1
+
+    messages, prompt_tokens = build_chat_messages(prompt, user_messages, external_data)
+    log_message("Context sent to the model", messages=len(messages), tokens=prompt_tokens, budget=OPENAI_CONTEXT_BUDGET, external_data=external_data)
     
-    try:
-        # Create a chat completion request with stream=True.
-        response = openai.ChatCompletion.create(
-            model='gpt-4',  
-            messages=[{"role": "user", "content": prompt_with_history}],
-            max_tokens=2000,
-            n=1,
-            temperature=0.5,
-            stream=True,
-        )
+    # global cap on the number of answers generated by the model at the same time
+    async with chat_scheduler.model_slots:
+        try:
+            with metrics.span("model"):
+                # Create an asynchronous chat completion request with stream=True so the event loop keeps serving other chats
+                started = time.perf_counter()
+                first_token_at = None
+                response = await openai.ChatCompletion.acreate(
+                    model=OPENAI_MODEL,  
+                    messages=messages,
+                    max_tokens=OPENAI_MAX_RESPONSE_TOKENS,
+                    n=1,
+                    temperature=0.5,
+                    stream=True,
+                )
+
+                # Iterate through the response chunks, the answer is shown in one message edited as it grows
+                message = ""
+                renderer = TelegramStreamRenderer(bot, chat_id)
+                async for chunk in response:
+                    if "choices" in chunk and len(chunk["choices"]) > 0:  # type: ignore
+                        delta = chunk["choices"][0]["delta"]  # type: ignore
+                        if "content" in delta:
+                            content = delta["content"]
+                            if first_token_at is None:
+                                first_token_at = time.perf_counter()
+                                metrics.observe("gptplus_model_first_token_seconds", first_token_at - started)
+                            message += content
+                            await renderer.feed(content)
+
+                streamed_at = time.perf_counter()
+                await renderer.finish()
+                log_message(f"Answer of {len(message)} characters shown with {renderer.api_calls} Telegram API calls")
 
-        # Iterate through the response chunks
-        message = ""
-        buffer = ""
-        for chunk in response:
-            if "choices" in chunk and len(chunk["choices"]) > 0:  # type: ignore
-                delta = chunk["choices"][0]["delta"]  # type: ignore
-                if "content" in delta:
-                    content = delta["content"]
-                    message += content
-                    buffer += content
-                    
-                    if "." in buffer:
-                        sentences = re.split(r'(?<!\d)\.(?=\s|$)', buffer)
-                        buffer = sentences.pop()
-                    
-                        for sentence in sentences:
-                            await bot.send_message(chat_id=chat_id, text=sentence, disable_web_page_preview=True)
-
-        if buffer:
-            await bot.send_message(chat_id=chat_id, text=buffer, disable_web_page_preview=True)
-
-        return message
+                completion_tokens = count_tokens(message)
+                if first_token_at is not None:
+                    metrics.observe("gptplus_model_tokens_per_second", completion_tokens / max(streamed_at - first_token_at, 0.001))
+                record_usage(chat_id, prompt_tokens, completion_tokens)
+                if cache_key and message:
+                    # the answer is reused as long as the freshest of its data sources
+                    ttl = min(RESPONSE_CACHE_SOURCE_TTLS[lookup[0]] for lookup in lookups)
+                    response_cache.set(cache_key, (message, prompt_tokens + completion_tokens), ttl)
+            return message
     
-    except Exception as e:
-        error_message = "Désolé, une erreur s'est produite lors du traitement de votre demande. Veuillez réessayer plus tard."
-        log_message(f"Erreur lors du traitement du message : {e}")
-        await bot.send_message(chat_id=chat_id, text=error_message)
-        log_message(f"Message d'erreur envoyé à l'utilisateur {chat_id} : {error_message}")
+        except asyncio.CancelledError:
+            log_message(f"Streaming of the answer cancelled for the chat {chat_id}")
+            raise
+
+        except Exception as e:
+            error_message = "Désolé, une erreur s'est produite lors du traitement de votre demande. Veuillez réessayer plus tard."
+            log_message(f"Erreur lors du traitement du message : {e}", level="ERROR")
+            await bot.send_message(chat_id=chat_id, text=error_message)
+            log_message(f"Message d'erreur envoyé à l'utilisateur {chat_id} : {error_message}")
+
+IMAGE_TRIGGER_RE = re.compile(r'\b(?:generate|génère)\b', re.IGNORECASE)
 
-def generate_image(prompt):
+async def generate_image(prompt):
     try:
-        response = openai.Image.create(
+        response = await openai.Image.acreate(
           prompt=prompt,
           n=1,
           size="1024x1024"
@@ -343,9 +1610,108 @@ def generate_image(prompt):
         return image_url
     except Exception as e:
         error_message = f"Une erreur s'est produite lors de la génération de l'image : {str(e)}"
-        log_message(f"Erreur lors de la génération de l'image : {str(e)}")
+        log_message(f"Erreur lors de la génération de l'image : {str(e)}", level="ERROR")
         return None
 
+# queue of image generations executed by a fixed number of workers, off the message handlers
+class ImageGenerationPool:
+    def __init__(self, workers, queue_size, cache_ttl):
+        self.workers = workers
+        self.queue = asyncio.Queue(maxsize=queue_size)
+        self.cache_ttl = cache_ttl
+        # normalized prompt -> future shared by every request waiting for the same image
+        self.in_flight = {}
+        # normalized prompt -> (image url, expiry), DALL·E urls are only valid for a limited time
+        self.cache = {}
+        self.tasks = []
+        self.latencies = collections.deque(maxlen=100)
+        self.jobs = 0
+        self.merged = 0
+        self.cache_hits = 0
+
+    @staticmethod
+    def normalize(prompt):
+        return " ".join(prompt.lower().split())
+
+    def start(self):
+        self.tasks = [asyncio.create_task(self.worker()) for _ in range(self.workers)]
+
+    async def stop(self):
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
+        for future in self.in_flight.values():
+            future.cancel()
+        self.in_flight.clear()
+
+    async def submit(self, prompt, chat_id=None):
+        key = self.normalize(prompt)
+        now = time.monotonic()
+        cached = self.cache.get(key)
+        if cached and cached[1] > now:
+            self.cache_hits += 1
+            log_message(f"Image for the prompt '{key}' served from the cache")
+            return cached[0]
+
+        future = self.in_flight.get(key)
+        if future is None:
+            future = asyncio.get_running_loop().create_future()
+            try:
+                self.queue.put_nowait((prompt, chat_id, future, now))
+            except asyncio.QueueFull:
+                raise Exception("Too many images are being generated, please try again later.")
+            self.in_flight[key] = future
+        else:
+            self.merged += 1
+            log_message(f"Image for the prompt '{key}' is already being generated, request merged")
+        # shield the shared job so that one cancelled waiter does not cancel it for the others
+        return await asyncio.shield(future)
+
+    async def worker(self):
+        while True:
+            prompt, chat_id, future, queued_at = await self.queue.get()
+            key = self.normalize(prompt)
+            started = time.monotonic()
+            try:
+                image_url = await generate_image(prompt)
+                if image_url:
+                    self.cache[key] = (image_url, time.monotonic() + self.cache_ttl)
+                    # a merged image is paid once, by the chat that asked for it first
+                    record_usage(chat_id, images=1)
+                if not future.done():
+                    future.set_result(image_url)
+            except Exception as e:
+                if not future.done():
+                    future.set_exception(e)
+            finally:
+                self.in_flight.pop(key, None)
+                self.queue.task_done()
+                self.prune_cache()
+
+            self.jobs += 1
+            latency = time.monotonic() - queued_at
+            self.latencies.append(latency)
+            log_message(f"Image generated in {latency:.1f}s (waited {started - queued_at:.1f}s in the queue), queue depth: {self.queue.qsize()}")
+
+    def prune_cache(self):
+        now = time.monotonic()
+        for key in [key for key, (_, expiry) in self.cache.items() if expiry <= now]:
+            del self.cache[key]
+
+    def stats(self):
+        average = sum(self.latencies) / len(self.latencies) if self.latencies else 0.0
+        return {
+            "queue_depth": self.queue.qsize(),
+            "in_flight": len(self.in_flight),
+            "jobs": self.jobs,
+            "merged": self.merged,
+            "cache_hits": self.cache_hits,
+            "average_latency": average,
+        }
+
+image_pool = ImageGenerationPool(IMAGE_WORKERS, IMAGE_QUEUE_SIZE, IMAGE_CACHE_TTL)
+
 async def start(message: types.Message):
     await message.reply("""
 Hi there! I'm a bot that uses the OpenAI GPT-4 API. Ask me questions, and I'll do my best to answer them! 
@@ -369,11 +1735,13 @@ async def chatid_command(message: types.Message):
 async def reset_command(message: types.Message, bot: Bot):
     user_id = message.from_user.id
     # security measures are implemented to allow only the authorized chat ID to receive messages and use your API key
-    authorized_chat_id = int(CHAT_ID)
-    if message.chat.id != authorized_chat_id:
+    if not is_authorized_chat(message.chat.id):
         await bot.send_message(message.chat.id, f"Unauthorized access from the user (your chat ID: {message.chat.id}). You can use my telegram bot with my code : https://github.com/Macmachi/gptplus/")
-        log_message(f"Unauthorized access attempt from chat ID: {message.chat.id}")
+        log_message(f"Unauthorized access attempt from chat ID: {message.chat.id}", level="WARNING")
+        metrics.inc("gptplus_unauthorized_total")
         return
+    # the answer being streamed would save the history it loaded before the reset, it is cancelled without saving
+    cancel_active_response(message.chat.id, user_id)
     result = reset_conversation_history(user_id)
     if result:
         await message.reply("Conversation history reset successfully.")
@@ -422,69 +1790,551 @@ My XMR wallet if you like my telegram bot : 47aRxaose3a6Uoi8aEo6sDPz3wiqfTePt725
     """
     await message.reply(help_message)
 
+# messages are run by chat_scheduler, RetryAfter is retried there
 async def handle_message(message: types.Message, bot: Bot):
-    try:
+    with metrics.span("message"):
         # security measures are implemented to allow only the authorized chat ID to receive messages and use your API key
         user_id = message.from_user.id
-        authorized_chat_id = int(CHAT_ID)
-        if message.chat.id != authorized_chat_id:
+        if not is_authorized_chat(message.chat.id):
             await bot.send_message(message.chat.id, f"Unauthorized access from the user (your chat ID: {message.chat.id}). You can use my telegram bot with my code : https://github.com/Macmachi/gptplus/")
-            log_message(f"Unauthorized access attempt from chat ID: {message.chat.id}")
+            log_message(f"Unauthorized access attempt from chat ID: {message.chat.id}", level="WARNING")
+            metrics.inc("gptplus_unauthorized_total")
             return
 
-        user_messages = load_conversation_history(user_id)
+        with metrics.span("history_load"):
+            user_messages = load_conversation_history(user_id)
 
         prompt = message.text
         log_message(f"value of the prompt coming from Telegram': {prompt}")
         # If the words "generate" or "génère" are present in the user's input
-        if re.search(r'\b(generate|génère)\b', prompt, re.IGNORECASE):
-            # Extract the text after "generate" or "génère" to use it as a prompt
-            prompt = re.split(r'\b(generate|génère)\b', prompt, flags=re.IGNORECASE)[-1].strip()
-            # We remove the words from the prompts
-            prompt = re.sub(r'\b(generate|génère)\b', '', prompt, flags=re.IGNORECASE).strip()
+        parts = IMAGE_TRIGGER_RE.split(prompt)
+        if len(parts) > 1:
+            # Extract the text after the last "generate" or "génère" to use it as a prompt
+            prompt = parts[-1].strip()
             # Generate an image and return the image URL
             try:
-                image_url = generate_image(prompt)
+                image_url = await image_pool.submit(prompt, message.chat.id)
                 if image_url is None:
                     raise Exception("Error while generating the image.")
                 await bot.send_photo(chat_id=message.chat.id, photo=image_url)
+            except RetryAfter:
+                raise
             except Exception as e:
+                metrics.inc("gptplus_errors_total", stage="image")
                 error_message = f"An error occurred while generating the image: {str(e)}"
-                log_message(f"Error while generating the image: {str(e)}")
+                log_message(f"Error while generating the image: {str(e)}", level="ERROR")
                 await bot.send_message(chat_id=message.chat.id, text=error_message)
         else:
-            response = ""
-            response = await get_gpt4_response(prompt, user_messages, bot, message.chat.id, authorized_chat_id)
+            task = asyncio.ensure_future(get_gpt4_response(prompt, user_messages, bot, message.chat.id))
+            active_responses[message.chat.id, user_id] = task
+            try:
+                await asyncio.wait({task})
+            except asyncio.CancelledError:
+                task.cancel()
+                raise
+            finally:
+                if active_responses.get((message.chat.id, user_id)) is task:
+                    del active_responses[message.chat.id, user_id]
+            if task.cancelled():
+                return
+            response = task.result()
             log_message(f"Réponse de l'api d'OpenAI ': {response}")
             # we format the unchanged user prompt
             user_messages.append({"role": "user", "content": prompt})
             # we format the response from OpenAI
             user_messages.append({"role": "gpt4", "content": response})
             # we save both of them in the conversation history
-            save_conversation_history(user_id, user_messages)
+            with metrics.span("history_save"):
+                save_conversation_history(user_id, user_messages)
+
+# runs the messages of each chat one after the other and the chats in parallel, with retries when Telegram asks to wait
+class ChatScheduler:
+    def __init__(self, max_model_calls, max_retries, retry_delay, retry_jitter):
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        self.retry_jitter = retry_jitter
+        # global cap on the number of answers generated by the model at the same time
+        self.model_slots = asyncio.Semaphore(max_model_calls)
+        # chat id -> jobs waiting, and the task running them
+        self.queues = {}
+        self.workers = {}
+        self.retries = 0
+
+    def submit(self, chat_id, job, name):
+        self.queues.setdefault(chat_id, collections.deque()).append((job, name))
+        if chat_id not in self.workers:
+            self.workers[chat_id] = asyncio.create_task(self.run_chat(chat_id))
+
+    async def run_chat(self, chat_id):
+        jobs = self.queues[chat_id]
+        try:
+            while jobs:
+                job, name = jobs.popleft()
+                await self.run(job, name)
+        finally:
+            del self.workers[chat_id]
+            if not jobs:
+                del self.queues[chat_id]
+
+    # cheap commands are run right away with the same retries, without waiting behind the messages of the chat
+    async def run_priority(self, job, name):
+        await self.run(job, name)
+
+    async def run(self, job, name):
+        for attempt in range(self.max_retries + 1):
+            try:
+                await job()
+                return
+            except RetryAfter as e:
+                if attempt == self.max_retries:
+                    log_message(f"{name} dropped after {attempt + 1} attempts, Telegram still asks to wait {e.timeout}s", level="ERROR")
+                    return
+                # exponential backoff with jitter so that the waiting chats do not all come back at the same second
+                delay = max(e.timeout, self.retry_delay * 2 ** attempt) * (1 + random.uniform(0, self.retry_jitter))
+                self.retries += 1
+                metrics.inc("gptplus_retry_after_total", source="scheduler")
+                log_message(f"{name}: Telegram asks to wait {e.timeout}s, retry {attempt + 1}/{self.max_retries} in {delay:.1f}s", level="WARNING")
+                await asyncio.sleep(delay)
+            except Exception as e:
+                log_message(f"Error while processing {name}: {e}", level="ERROR")
+                metrics.inc("gptplus_errors_total", stage="handler")
+                return
 
-    except RetryAfter as exception:
-        log_message(f"Exception {exception} caught for update {message}. Retrying after {exception.timeout} seconds.")
-        await asyncio.sleep(exception.timeout)
-        await handle_message(message, bot)
+    def stats(self):
+        return {"chats": len(self.workers), "queued": sum(len(jobs) for jobs in self.queues.values()), "retries": self.retries}
+
+    # waits for the chats that still have messages to run, used before a worker of the supervisor mode exits
+    async def drain(self, timeout):
+        deadline = time.monotonic() + timeout
+        while self.workers:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                log_message(f"{self.stats()['queued']} messages of {len(self.workers)} chats were not processed within {timeout}s", level="WARNING")
+                return
+            await asyncio.wait(list(self.workers.values()), timeout=remaining)
+
+    async def stop(self):
+        workers = list(self.workers.values())
+        for task in workers:
+            task.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+
+chat_scheduler = ChatScheduler(SCHEDULER_MAX_MODEL_CALLS, SCHEDULER_MAX_RETRIES, SCHEDULER_RETRY_DELAY, SCHEDULER_RETRY_JITTER)
+
+def cancel_active_response(chat_id, user_id):
+    # a new message cancels the answer that is still streaming for its user, the other members of a group keep theirs
+    previous_task = active_responses.get((chat_id, user_id))
+    if previous_task is not None and not previous_task.done():
+        previous_task.cancel()
+        log_message(f"New message from the user {user_id} in the chat {chat_id}, cancelling the previous answer")
+
+async def dispatch_message(message: types.Message, bot: Bot):
+    cancel_active_response(message.chat.id, message.from_user.id)
+    chat_scheduler.submit(message.chat.id, lambda: handle_message(message, bot), f"message {message.message_id} of the chat {message.chat.id}")
+
+def priority_command(command, *args):
+    async def run(message: types.Message):
+        await chat_scheduler.run_priority(lambda: command(message, *args), f"command {message.text} of the chat {message.chat.id}")
+    return run
 
 async def on_telegram_api_error(exception: TelegramAPIError, bot: Bot, update: types.Update):
     log_message(f"Exception {exception} caught for update {update}. Skipping this update.")
+    metrics.inc("gptplus_errors_total", stage="telegram")
     
-async def main():
-    bot = Bot(token=TELEGRAM_BOT_TOKEN)
+# webhook ingestion: Telegram posts the updates to an embedded aiohttp server, a bounded queue feeds the dispatcher
+class WebhookServer:
+    def __init__(self, dp, queue_size, workers, drain_timeout, secret_token):
+        self.dp = dp
+        self.queue = asyncio.Queue(maxsize=queue_size)
+        self.workers = workers
+        self.drain_timeout = drain_timeout
+        self.secret_token = secret_token
+        self.accepting = False
+        self.runner = None
+        self.tasks = []
+        self.received = 0
+        self.rejected = 0
+        self.latencies = collections.deque(maxlen=1000)
+
+    def create_app(self):
+        app = web.Application()
+        app.router.add_post(WEBHOOK_PATH, self.receive_update)
+        return app
+
+    async def receive_update(self, request):
+        # anyone reaching the server could otherwise post an update from the authorized chat
+        secret_token = request.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+        if not hmac.compare_digest(secret_token.encode(), self.secret_token.encode()):
+            log_message(f"Webhook call with a wrong secret token from {request.remote}", level="WARNING")
+            return web.Response(status=403)
+        # when the queue is full or the bot is stopping, Telegram is told to send the update again later
+        if not self.accepting:
+            return web.Response(status=503)
+        try:
+            data = await request.json()
+        except ValueError:
+            return web.Response(status=400)
+        try:
+            self.queue.put_nowait((data, time.monotonic()))
+        except asyncio.QueueFull:
+            self.rejected += 1
+            log_message(f"Webhook queue full ({self.queue.qsize()} updates), update {data.get('update_id')} refused", level="WARNING")
+            return web.Response(status=503)
+        self.received += 1
+        return web.Response()
+
+    async def worker(self):
+        # the handlers use Bot.get_current() and Dispatcher.get_current() like with polling
+        Bot.set_current(self.dp.bot)
+        Dispatcher.set_current(self.dp)
+        while True:
+            data, received_at = await self.queue.get()
+            try:
+                await self.dp.process_update(types.Update(**data))
+            except Exception as e:
+                log_message(f"Error while processing the update {data.get('update_id')}: {e}", level="ERROR")
+            finally:
+                self.latencies.append(time.monotonic() - received_at)
+                self.queue.task_done()
+
+    async def start(self, host, port):
+        self.tasks = [asyncio.create_task(self.worker()) for _ in range(self.workers)]
+        self.runner = web.AppRunner(self.create_app())
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, host, port)
+        await site.start()
+        self.accepting = True
+        log_message(f"Webhook server listening on {host}:{port}{WEBHOOK_PATH}")
+
+    async def stop(self):
+        # stop accepting updates, let the workers finish the queued ones, then close the server
+        self.accepting = False
+        try:
+            await asyncio.wait_for(self.queue.join(), self.drain_timeout)
+        except asyncio.TimeoutError:
+            log_message(f"{self.queue.qsize()} updates were not processed within {self.drain_timeout}s", level="WARNING")
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        if self.runner is not None:
+            await self.runner.cleanup()
+        log_message(f"Webhook stats: {self.stats()}")
+
+    def stats(self):
+        latencies = sorted(self.latencies)
+        return {
+            "queue_depth": self.queue.qsize(),
+            "received": self.received,
+            "rejected": self.rejected,
+            "p50_latency": latencies[len(latencies) // 2] if latencies else 0.0,
+            "p99_latency": latencies[int(len(latencies) * 0.99) - 1] if latencies else 0.0,
+        }
+
+async def run_webhook(dp):
+    server = WebhookServer(dp, WEBHOOK_QUEUE_SIZE, WEBHOOK_WORKERS, WEBHOOK_DRAIN_TIMEOUT, WEBHOOK_SECRET_TOKEN)
+    await server.start(WEBHOOK_HOST, WEBHOOK_PORT)
+    await dp.bot.set_webhook(WEBHOOK_URL, secret_token=WEBHOOK_SECRET_TOKEN)
+
+    stopping = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for signal_number in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(signal_number, stopping.set)
+        except NotImplementedError:
+            # signal handlers are not available on Windows, Ctrl+C cancels the task instead
+            pass
+    try:
+        await stopping.wait()
+    finally:
+        await server.stop()
+        # the text handler only queues the messages, they are finished before chat_scheduler.stop() cancels what is left
+        await chat_scheduler.drain(WEBHOOK_DRAIN_TIMEOUT)
+
+def create_dispatcher(bot):
     dp = Dispatcher(bot)
-    dp.middleware.setup(LoggingMiddleware())
-    dp.register_message_handler(start, commands=['start'])
-    dp.register_message_handler(aide_command, commands=['aide'])
-    dp.register_message_handler(help_command, commands=['help'])
-    dp.register_message_handler(chatid_command, commands=['chatid'])
-    dp.register_message_handler(lambda message: reset_command(message, bot), commands=['reset'])
-    dp.register_message_handler(lambda message: handle_message(message, bot), content_types=['text'])
+    if LOG_AIOGRAM_MIDDLEWARE:
+        dp.middleware.setup(LoggingMiddleware())
+    dp.register_message_handler(priority_command(start), commands=['start'])
+    dp.register_message_handler(priority_command(aide_command), commands=['aide'])
+    dp.register_message_handler(priority_command(help_command), commands=['help'])
+    dp.register_message_handler(priority_command(chatid_command), commands=['chatid'])
+    dp.register_message_handler(priority_command(reset_command, bot), commands=['reset'])
+    dp.register_message_handler(lambda message: dispatch_message(message, bot), content_types=['text'])
     # add these lines to save the error handlers
     dp.register_errors_handler(on_telegram_api_error, exception=TelegramAPIError)
-    # start polling
-    await dp.start_polling()
+    return dp
+
+# supervisor mode: the front process sends the updates of each chat to the same worker process, as JSON lines on its stdin,
+# so that the messages of a chat keep their order and each worker owns the conversations of its chats
+class ShardSupervisor:
+    def __init__(self, workers, drain_timeout, restart_delay, command=None):
+        self.workers = workers
+        self.drain_timeout = drain_timeout
+        self.restart_delay = restart_delay
+        self.command = command or [sys.executable, os.path.realpath(__file__)]
+        self.processes = [None] * workers
+        # worker index -> updates kept while the worker is replaced, sent in order to the new process
+        self.held = {}
+        self.stopping = False
+        self.tasks = set()
+        self.forwarded = [0] * workers
+        self.restarts = 0
+        self.lost = 0
+
+    def shard_of(self, chat_id):
+        digest = hashlib.blake2b(str(chat_id).encode(), digest_size=8).digest()
+        return int.from_bytes(digest, "big") % self.workers
+
+    async def start(self):
+        for index in range(self.workers):
+            await self.start_worker(index)
+
+    async def start_worker(self, index):
+        process = await asyncio.create_subprocess_exec(*self.command, stdin=asyncio.subprocess.PIPE, env={**os.environ, "GPTPLUS_SHARD": str(index)})
+        self.processes[index] = process
+        self.run_task(self.watch(index, process))
+        log_message(f"Worker {index} started with the pid {process.pid}")
+
+    def run_task(self, coroutine):
+        task = asyncio.create_task(coroutine)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def send(self, chat_id, update):
+        # the update is written before the first await so that the updates keep the order in which they were received
+        index = self.shard_of(chat_id)
+        line = (json.dumps(update, ensure_ascii=False) + "\n").encode()
+        if index in self.held:
+            self.held[index].append(line)
+            return
+        stdin = self.processes[index].stdin
+        stdin.write(line)
+        self.forwarded[index] += 1
+        try:
+            # waits when the worker is behind, instead of buffering without limit
+            await stdin.drain()
+        except ConnectionError:
+            self.lost += 1
+            log_message(f"Update {update.get('update_id')} lost, the worker {index} stopped before reading it", level="ERROR")
+
+    async def watch(self, index, process):
+        returncode = await process.wait()
+        if self.stopping or index in self.held or self.processes[index] is not process:
+            return
+        # a worker that crashed is started again, its new updates are held until then
+        log_message(f"Worker {index} exited with the code {returncode}, restarting it in {self.restart_delay}s", level="ERROR")
+        self.held[index] = []
+        await asyncio.sleep(self.restart_delay)
+        await self.replace_worker(index)
+
+    async def replace_worker(self, index):
+        await self.start_worker(index)
+        held = self.held.pop(index)
+        stdin = self.processes[index].stdin
+        for line in held:
+            stdin.write(line)
+        self.forwarded[index] += len(held)
+        self.restarts += 1
+        await stdin.drain()
+
+    async def stop_worker(self, index):
+        process = self.processes[index]
+        # closing stdin asks the worker to finish the messages it received and to exit
+        process.stdin.close()
+        try:
+            await asyncio.wait_for(process.wait(), self.drain_timeout + 10)
+        except asyncio.TimeoutError:
+            log_message(f"Worker {index} did not stop within {self.drain_timeout + 10}s, killing it", level="WARNING")
+            process.kill()
+            await process.wait()
+
+    # graceful restart of one worker: the updates of its chats wait in the front process meanwhile
+    async def restart(self, index):
+        if index in self.held:
+            return
+        self.held[index] = []
+        await self.stop_worker(index)
+        await self.replace_worker(index)
+
+    # rolling restart, one worker after the other (SIGHUP), e.g. to load a new version of the code
+    async def restart_all(self):
+        for index in range(self.workers):
+            await self.restart(index)
+        log_message(f"All the workers were restarted: {self.stats()}")
+
+    async def stop(self):
+        self.stopping = True
+        await asyncio.gather(*(self.stop_worker(index) for index in range(self.workers) if self.processes[index] is not None))
+        log_message(f"Supervisor stats: {self.stats()}")
+
+    def stats(self):
+        return {"workers": self.workers, "forwarded": list(self.forwarded), "held": sum(len(lines) for lines in self.held.values()), "restarts": self.restarts, "lost": self.lost}
+
+    def collect_metrics(self):
+        for index, count in enumerate(self.forwarded):
+            yield "gptplus_shard_forwarded_updates_total", "counter", {"shard": index}, count
+        yield "gptplus_shard_held_updates", "gauge", {}, sum(len(lines) for lines in self.held.values())
+        yield "gptplus_shard_restarts_total", "counter", {}, self.restarts
+        yield "gptplus_shard_lost_updates_total", "counter", {}, self.lost
+
+# the history is keyed by user but only the CHAT_ID chat is answered, so the conversations of a user are all on the worker of that chat,
+# and the messages of a chat keep their order and share the rate limit of one worker
+def update_chat_id(update):
+    for field in ("message", "edited_message", "channel_post", "edited_channel_post"):
+        message = getattr(update, field)
+        if message:
+            return message.chat.id
+    if update.callback_query and update.callback_query.message:
+        return update.callback_query.message.chat.id
+    # the updates without a chat go to the worker of their user
+    for field in ("inline_query", "chosen_inline_result", "callback_query", "shipping_query", "pre_checkout_query", "my_chat_member", "chat_member", "chat_join_request"):
+        item = getattr(update, field)
+        if item and getattr(item, "from_user", None):
+            return item.from_user.id
+    return 0
+
+# dispatcher of the front process: every update is sent to the worker of its chat instead of the handlers
+class ShardRouter(Dispatcher):
+    def __init__(self, bot, supervisor):
+        super().__init__(bot)
+        self.supervisor = supervisor
+
+    async def process_update(self, update: types.Update):
+        await self.supervisor.send(update_chat_id(update), update.to_python())
+
+async def run_supervisor():
+    # the workers share the sqlite history, each one only reading and writing the conversations of its chats
+    if HISTORY_BACKEND != "sqlite":
+        log_message("The supervisor mode ([SHARDS] WORKERS > 1) needs the sqlite history backend", level="ERROR")
+        return
+    backend = SQLiteHistoryBackend(HISTORY_DATABASE)
+    try:
+        migrate_json_history(backend, HISTORY_JSON_FILE)
+    finally:
+        backend.close()
+    if REFRESH_ENABLED:
+        log_message("The background refresh ([REFRESH] ENABLED) is not run by the workers of the supervisor mode, each of them would call the APIs", level="WARNING")
+    supervisor = ShardSupervisor(SHARDS_WORKERS, SHARDS_DRAIN_TIMEOUT, SHARDS_RESTART_DELAY)
+    await supervisor.start()
+    bot = create_bot()
+    dp = ShardRouter(bot, supervisor)
+    metrics.collectors = [supervisor.collect_metrics]
+    metrics_runner = None
+    if METRICS_ENABLED:
+        metrics_runner = await start_metrics_server(METRICS_HOST, METRICS_PORT)
+    if hasattr(signal, "SIGHUP"):
+        asyncio.get_running_loop().add_signal_handler(signal.SIGHUP, lambda: supervisor.run_task(supervisor.restart_all()))
+    try:
+        if TELEGRAM_MODE == "webhook":
+            await run_webhook(dp)
+        else:
+            await bot.delete_webhook()
+            # one batch of updates after the other, in order
+            await dp.start_polling(fast=False)
+    finally:
+        await supervisor.stop()
+        if metrics_runner is not None:
+            await metrics_runner.cleanup()
+        await bot.close()
+
+# worker of the supervisor mode: the updates of its chats are read on stdin until the front process closes it
+async def run_shard_worker(dp):
+    # Ctrl+C reaches every process of the terminal, the worker waits for the front process to close its stdin instead
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    Bot.set_current(dp.bot)
+    Dispatcher.set_current(dp)
+    reader = asyncio.StreamReader(limit=2 ** 24)
+    await asyncio.get_running_loop().connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader), sys.stdin)
+    log_message(f"Worker {SHARD_INDEX} ready (pid {os.getpid()})")
+    processed = 0
+    while True:
+        line = await reader.readline()
+        if not line:
+            break
+        try:
+            await dp.process_update(types.Update(**json.loads(line)))
+        except Exception as e:
+            log_message(f"Error while processing an update in the worker {SHARD_INDEX}: {e}", level="ERROR")
+        processed += 1
+    await chat_scheduler.drain(SHARDS_DRAIN_TIMEOUT)
+    log_message(f"Worker {SHARD_INDEX} stopped after {processed} updates")
+
+# values read each time /metrics is called
+def collect_runtime_metrics():
+    for cache in caches + [response_cache]:
+        stats = cache.stats()
+        yield "gptplus_cache_entries", "gauge", {"cache": cache.name}, stats["size"]
+        for result in ("hits", "misses", "coalesced", "stale_hits"):
+            yield "gptplus_cache_lookups_total", "counter", {"cache": cache.name, "result": result}, stats[result]
+    yield "gptplus_response_cache_saved_tokens_total", "counter", {}, response_cache_saved_tokens
+    scheduler_stats = chat_scheduler.stats()
+    yield "gptplus_scheduler_active_chats", "gauge", {}, scheduler_stats["chats"]
+    yield "gptplus_scheduler_queued_messages", "gauge", {}, scheduler_stats["queued"]
+    yield "gptplus_active_responses", "gauge", {}, len(active_responses)
+    yield "gptplus_image_queue_size", "gauge", {}, image_pool.queue.qsize()
+
+metrics.collectors.append(collect_runtime_metrics)
+
+def create_openai_session():
+    # a single pooled HTTP session reused by every OpenAI request instead of a new connection per call
+    connector = aiohttp.TCPConnector(limit=OPENAI_MAX_CONNECTIONS, keepalive_timeout=OPENAI_KEEPALIVE_TIMEOUT)
+    session = aiohttp.ClientSession(connector=connector)
+    openai.aiosession.set(session)
+    return session
+
+def create_bot():
+    server = TelegramAPIServer.from_base(TELEGRAM_BASE_URL) if TELEGRAM_BASE_URL else TELEGRAM_PRODUCTION
+    return Bot(token=TELEGRAM_BOT_TOKEN, server=server)
+
+async def main():
+    global conversation_store, http_client
+    if SHARD_INDEX is None and SHARDS_WORKERS > 1:
+        await run_supervisor()
+        return
+    conversation_store = create_history_store()
+    conversation_store.start()
+    http_client = create_http_client()
+    openai_session = create_openai_session()
+    metrics_runner = None
+    if METRICS_OPENTELEMETRY:
+        metrics.tracer = create_tracer()
+    if METRICS_ENABLED:
+        # the front process of the supervisor mode uses PORT, its workers the next ports
+        metrics_port = METRICS_PORT if SHARD_INDEX is None else METRICS_PORT + 1 + SHARD_INDEX
+        metrics_runner = await start_metrics_server(METRICS_HOST, metrics_port)
+    # the tiktoken encoding may be downloaded on its first use
+    await asyncio.to_thread(load_token_encoding)
+    bot = create_bot()
+    dp = create_dispatcher(bot)
+    image_pool.start()
+    refresher = create_background_refresher()
+    # every worker of the supervisor mode has its own caches, a refresher in each one would multiply the calls to the APIs
+    if REFRESH_ENABLED and SHARD_INDEX is None:
+        refresher.start()
+    try:
+        if SHARD_INDEX is not None:
+            await run_shard_worker(dp)
+        elif TELEGRAM_MODE == "webhook":
+            await run_webhook(dp)
+        else:
+            # start polling, a webhook left by the webhook mode would prevent it
+            await bot.delete_webhook()
+            await dp.start_polling()
+    finally:
+        log_message(f"Image generation stats: {image_pool.stats()}")
+        log_message(f"Usage since start: {usage_totals}")
+        await refresher.stop()
+        await chat_scheduler.stop()
+        await image_pool.stop()
+        await openai_session.close()
+        log_http_latencies()
+        close_caches()
+        await http_client.aclose()
+        await conversation_store.close()
+        await bot.close()
+        if metrics_runner is not None:
+            await metrics_runner.cleanup()
+        shutdown_tracer()
 
 if __name__ == '__main__':
     asyncio.run(main())